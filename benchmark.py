@@ -0,0 +1,272 @@
+import fonlinepy.protofile as protofile
+import fonlinepy.protocache as protocache
+import fonlinepy.protoindex as protoindex
+import fonlinepy.protoquery as protoquery
+import fonlinepy.headerparser as headerparser
+import fonlinepy.itemflags as itemflags
+import fonlinepy.macros as macros
+import fonlinepy.msgfile as msgfile
+import fonlinepy.msgcorpus as msgcorpus
+import fonlinepy.frmparser as frmparser
+import fonlinepy.synthetic as synthetic
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import tracemalloc
+from collections import OrderedDict
+
+"""
+	Benchmarks the parsers on synthetic server data.
+
+	Usage
+
+		python3 benchmark.py --output results.json
+
+	Generates a synthetic server tree (see fonlinepy/synthetic.py) into a
+	temporary folder, runs every benchmark and saves the results into
+	'results.json'. Each benchmark is timed --repeat times and then run once
+	more under tracemalloc to measure its peak memory use.
+
+		python3 benchmark.py --files 100 --protos 2000 --data /tmp/bench
+
+	Sets the scale of the generated data and keeps it in '/tmp/bench', so
+	that later runs with --data reuse it instead of generating it again.
+
+		python3 benchmark.py --compare results.json --only proto
+
+	Runs the benchmarks whose name contains 'proto' and prints their times
+	relative to the saved results.
+
+	Files are read in the main process, so that the times and memory use
+	are those of the parsers rather than of the worker processes.
+"""
+
+RESULTS_VERSION = 1
+
+class Context:
+	def __init__(self, server_path, work_path):
+		self.server_path = server_path # synthetic server tree
+		self.work_path = work_path # folder for caches and outputs
+		self.items_path = os.path.join(server_path, protofile.PROTO_PATH)
+		self.defines_path = os.path.join(server_path, "scripts", "_defines.fos")
+		self.msg_paths = [os.path.join(server_path, msgcorpus.TEXT_PATH, x, "FOOBJ.MSG") for x in ("engl", "russ")]
+		self.art_path = os.path.join(server_path, "art", "items")
+
+	def read_protos(self, cache=None, read_lines=True):
+		protos = protofile.load_freestanding_proto_files(self.items_path)
+		return protofile.read_proto_files(protos, 1, cache=cache, read_lines=read_lines)
+
+	def fresh_path(self, name):
+		path = os.path.join(self.work_path, name)
+		shutil.rmtree(path, ignore_errors=True)
+		return path
+
+"""
+	Each benchmark is set up with the Context and returns the function to
+	time. The set up is not timed.
+"""
+
+def bench_proto_parse(ctx):
+	return lambda: ctx.read_protos()
+
+def bench_proto_parse_streaming(ctx):
+	return lambda: ctx.read_protos(read_lines=False)
+
+def bench_proto_cache_cold(ctx):
+	def run():
+		cache = protocache.ProtoCache(ctx.fresh_path("proto_cache_cold"))
+		ctx.read_protos(cache, read_lines=False)
+	return run
+
+def bench_proto_cache_warm(ctx):
+	cache = protocache.ProtoCache(ctx.fresh_path("proto_cache_warm"))
+	ctx.read_protos(cache, read_lines=False)
+	return lambda: ctx.read_protos(cache, read_lines=False)
+
+def bench_proto_rewrite(ctx):
+	protos = ctx.read_protos()
+	def run():
+		for x in protos:
+			with x.batch() as updates:
+				for pid, section in x.sections.items():
+					data = OrderedDict(section.proto.data)
+					data["Cost"] = str(int(data.get("Cost", "0")) + 1)
+					updates[pid] = data
+			x.lines
+	return run
+
+def bench_proto_index(ctx):
+	protos = ctx.read_protos(read_lines=False)
+	def run():
+		index = protoindex.ProtoIndex(protos)
+		index.conflicts()
+		index.free_pids(1000)
+	return run
+
+def bench_proto_query(ctx):
+	protos = ctx.read_protos(read_lines=False)
+	def run():
+		table = protoquery.ProtoTable(protos)
+		table.select(["Type=3", "Cost>50000"])
+		table.select(["Flags&32"])
+	return run
+
+def bench_defines_cold(ctx):
+	return lambda: headerparser.DefineTable(ctx.defines_path).load()
+
+def bench_defines_warm(ctx):
+	cache_path = ctx.fresh_path("define_cache")
+	headerparser.DefineTable(ctx.defines_path).load(cache_path)
+	return lambda: headerparser.DefineTable(ctx.defines_path).load(cache_path)
+
+def bench_macro_reverse(ctx):
+	defines = headerparser.DefineTable(ctx.defines_path).load().values
+	iflags = itemflags.ItemFlags(defines, headerparser.get_item_flags(defines))
+	engine = macros.standard_engine(defines, iflags)
+	protos = ctx.read_protos(read_lines=False)
+	fields = [(k, v) for x in protos for s in x.sections.values() for k, v in s.proto.data.items()]
+	def run():
+		reverse = engine.reverse
+		for k, v in fields:
+			reverse(k, v)
+	return run
+
+def bench_msg_parse(ctx):
+	def run():
+		for path in ctx.msg_paths:
+			with msgfile.MsgFile.open(path) as msg:
+				for entry in msg.entries():
+					pass
+	return run
+
+def bench_msg_corpus_cold(ctx):
+	text_path = os.path.join(ctx.server_path, msgcorpus.TEXT_PATH)
+	return lambda: msgcorpus.MsgCorpus().load(text_path, workers=1)
+
+def bench_msg_corpus_warm(ctx):
+	text_path = os.path.join(ctx.server_path, msgcorpus.TEXT_PATH)
+	cache_path = os.path.join(ctx.work_path, "msg_cache")
+	if os.path.exists(cache_path):
+		os.unlink(cache_path)
+	msgcorpus.MsgCorpus().load(text_path, cache_path, workers=1)
+	return lambda: msgcorpus.MsgCorpus().load(text_path, cache_path, workers=1)
+
+def bench_frm_parse(ctx):
+	paths = frmparser.find_frm_files(ctx.art_path)
+	def run():
+		for path in paths:
+			with frmparser.FrmFile.open(path) as frm:
+				count = sum(len(frm.direction(d)) for d in frm.unique_directions())
+	return run
+
+BENCHMARKS = OrderedDict([
+	("proto_parse", bench_proto_parse),
+	("proto_parse_streaming", bench_proto_parse_streaming),
+	("proto_cache_cold", bench_proto_cache_cold),
+	("proto_cache_warm", bench_proto_cache_warm),
+	("proto_rewrite", bench_proto_rewrite),
+	("proto_index", bench_proto_index),
+	("proto_query", bench_proto_query),
+	("defines_cold", bench_defines_cold),
+	("defines_warm", bench_defines_warm),
+	("macro_reverse", bench_macro_reverse),
+	("msg_parse", bench_msg_parse),
+	("msg_corpus_cold", bench_msg_corpus_cold),
+	("msg_corpus_warm", bench_msg_corpus_warm),
+	("frm_parse", bench_frm_parse),
+])
+
+def run_benchmark(ctx, setup, repeat):
+	"""
+		Time the function returned by setup 'repeat' times, then measure its
+		peak memory use. Returns dictionary of the results.
+	"""
+	run = setup(ctx)
+	times = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		run()
+		times.append(time.perf_counter() - start)
+	tracemalloc.start()
+	try:
+		run()
+		peak = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	times.sort()
+	return {
+		"times": times,
+		"min": times[0],
+		"median": times[len(times) // 2],
+		"peak_memory": peak
+	}
+
+def generate(server_path, args):
+	print("Generating synthetic server in {}".format(server_path), file=sys.stderr)
+	synthetic.write_server(server_path, args.files, args.protos, args.defines,
+		args.frms, args.frames, args.seed)
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="fonlinepy benchmarks")
+	parser.add_argument("--output", type=str, help="save the results into a JSON file")
+	parser.add_argument("--compare", type=str, help="compare with results saved with --output")
+	parser.add_argument("--data", type=str, help="folder of the synthetic data, generated if it doesn't exist")
+	parser.add_argument("--only", type=str, help="run only the benchmarks whose name contains this")
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--files", type=int, default=20, help="number of fopro files")
+	parser.add_argument("--protos", type=int, default=500, help="number of protos per fopro file")
+	parser.add_argument("--defines", type=int, default=2000, help="number of defines")
+	parser.add_argument("--frms", type=int, default=20, help="number of FRM files")
+	parser.add_argument("--frames", type=int, default=8, help="number of frames per FRM direction")
+	parser.add_argument("--seed", type=int, default=0)
+	args = parser.parse_args()
+	logging.disable(logging.WARNING)
+
+	tmp_path = tempfile.mkdtemp(prefix="fonlinepy_bench_")
+	try:
+		server_path = args.data or os.path.join(tmp_path, "server")
+		if not os.path.exists(server_path):
+			generate(server_path, args)
+		ctx = Context(server_path, tmp_path)
+
+		baseline = {}
+		if args.compare:
+			with open(args.compare) as f:
+				baseline = json.load(f)["results"]
+
+		results = OrderedDict()
+		for name, setup in BENCHMARKS.items():
+			if args.only and args.only not in name:
+				continue
+			result = run_benchmark(ctx, setup, args.repeat)
+			results[name] = result
+			line = "{:<24} {:>10.4f} s {:>10.1f} MiB".format(name, result["min"], result["peak_memory"] / 2**20)
+			if name in baseline:
+				line += " {:>7.2f}x".format(result["min"] / baseline[name]["min"])
+			print(line)
+	finally:
+		shutil.rmtree(tmp_path, ignore_errors=True)
+
+	if args.output:
+		with open(args.output, "wt") as f:
+			json.dump({
+				"version": RESULTS_VERSION,
+				"python": platform.python_version(),
+				"platform": platform.platform(),
+				"parameters": {
+					"files": args.files,
+					"protos": args.protos,
+					"defines": args.defines,
+					"frms": args.frms,
+					"frames": args.frames,
+					"seed": args.seed,
+					"repeat": args.repeat
+				},
+				"results": results
+			}, f, indent=1)
@@ -0,0 +1,169 @@
+import os
+import asyncio
+import logging
+import concurrent.futures
+from collections import OrderedDict
+import fonlinepy.protofile as protofile
+import fonlinepy.headerparser as headerparser
+
+"""
+
+	Asyncio API for loading fopro files and headers
+
+	Disk access runs in the default executor of the event loop and at most
+	'max_open' files are read at a time. Parsing runs in the given executor,
+	a ProcessPoolExecutor for CPU-bound work, or the default executor if
+	none is given. Example:
+
+		async for proto_file in aio.iter_freestanding_proto_files(path, executor=pool):
+			...
+
+	yields the ProtoFiles of the folder as soon as each is parsed.
+
+"""
+
+MAX_OPEN_FILES = 16
+
+def _read_text(path, errors=None):
+	with open(path, errors=errors) as f:
+		return f.read()
+
+def _read_proto_text(path):
+	with open(path) as f:
+		st = os.fstat(f.fileno())
+		return f.read(), (st.st_mtime_ns, st.st_size)
+
+def _parse_proto_file(proto_file, text, read_lines):
+	lines = text.split("\n")
+	if len(lines) > 0 and lines[-1] == "":
+		lines.pop()
+	if read_lines:
+		proto_file.lines = lines
+		proto_file.lines_pending = False
+		proto_file.read_sections()
+	else:
+		proto_file.read_sections_streaming(lines)
+	return proto_file
+
+def _parse_proto_file_in_worker(proto_file, text, read_lines, log_level):
+	root = logging.getLogger()
+	old_handlers, old_level = root.handlers, root.level
+	collector = protofile._LogCollector()
+	root.handlers = [collector]
+	root.setLevel(log_level)
+	try:
+		_parse_proto_file(proto_file, text, read_lines)
+	finally:
+		root.handlers = old_handlers
+		root.setLevel(old_level)
+	return proto_file, collector.records
+
+async def scan_proto_files(target_path):
+	"""
+		Get the unread ProtoFiles of directory target_path, see
+		protofile.load_freestanding_proto_files
+	"""
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(None, protofile.load_freestanding_proto_files, target_path)
+
+async def read_proto_file(proto_file, semaphore, executor=None, cache=None, read_lines=True):
+	"""
+		Read and parse proto_file as in ProtoFile.load. The file is read while
+		holding semaphore. Returns the read ProtoFile, a copy of proto_file if
+		executor is a ProcessPoolExecutor.
+	"""
+	loop = asyncio.get_running_loop()
+	proto_file.sections = OrderedDict()
+	proto_file.invalid_ranges = []
+	proto_file.read_stamp = None
+	if cache is not None:
+		async with semaphore:
+			cached = await loop.run_in_executor(None, cache.load_sections, proto_file)
+		if cached and not read_lines:
+			proto_file.lines_pending = True
+			return proto_file
+		if cached:
+			stamp = proto_file.read_stamp
+			async with semaphore:
+				await loop.run_in_executor(None, proto_file.read_file)
+			if proto_file.read_stamp == stamp:
+				return proto_file
+			# Modified after the cache entry was checked, parse it instead
+			proto_file.sections = OrderedDict()
+			proto_file.invalid_ranges = []
+
+	key = None
+	async with semaphore:
+		if cache is not None:
+			try:
+				key = await loop.run_in_executor(None, cache.file_key, proto_file.path)
+			except OSError:
+				pass
+		text, proto_file.read_stamp = await loop.run_in_executor(None, _read_proto_text, proto_file.path)
+	if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+		log_level = logging.getLogger().getEffectiveLevel()
+		proto_file, records = await loop.run_in_executor(executor,
+			_parse_proto_file_in_worker, proto_file, text, read_lines, log_level)
+		for record in records:
+			logging.getLogger(record.name).handle(record)
+	else:
+		await loop.run_in_executor(executor, _parse_proto_file, proto_file, text, read_lines)
+
+	if key is not None:
+		async with semaphore:
+			await loop.run_in_executor(None, cache.store_sections, proto_file, key)
+	return proto_file
+
+async def iter_proto_files(proto_files, executor=None, cache=None, read_lines=True, max_open=MAX_OPEN_FILES):
+	"""
+		Read the ProtoFiles proto_files concurrently, generating them in the
+		order they finish. At most max_open files are read at a time.
+		Exceptions such as OSError are raised in the caller, and the
+		remaining files are not read.
+	"""
+	semaphore = asyncio.Semaphore(max_open)
+	tasks = [asyncio.ensure_future(read_proto_file(x, semaphore, executor, cache, read_lines)) for x in proto_files]
+	try:
+		for task in asyncio.as_completed(tasks):
+			yield await task
+	finally:
+		for task in tasks:
+			task.cancel()
+
+async def iter_freestanding_proto_files(target_path, executor=None, cache=None, read_lines=True, max_open=MAX_OPEN_FILES):
+	"""
+		Scan directory target_path and generate its read ProtoFiles as they
+		finish, see iter_proto_files
+	"""
+	proto_files = await scan_proto_files(target_path)
+	async for x in iter_proto_files(proto_files, executor, cache, read_lines, max_open):
+		yield x
+
+async def read_proto_files(proto_files, executor=None, cache=None, read_lines=True, max_open=MAX_OPEN_FILES):
+	"""
+		Read the ProtoFiles proto_files concurrently. Returns list of the read
+		ProtoFiles in the same order as proto_files.
+	"""
+	semaphore = asyncio.Semaphore(max_open)
+	return list(await asyncio.gather(*(read_proto_file(x, semaphore, executor, cache, read_lines) for x in proto_files)))
+
+def _parse_header_text(text):
+	return list(headerparser.parse_header(text.split("\n")))
+
+async def parse_header_file(server, f, executor=None):
+	"""
+		Get list of (name, value) pairs of the defines of header file f of
+		server server, see headerparser.parse_header_file
+	"""
+	loop = asyncio.get_running_loop()
+	p = os.path.join(server, f)
+	text = await loop.run_in_executor(None, _read_text, p, 'ignore')
+	return await loop.run_in_executor(executor, _parse_header_text, text)
+
+async def load_define_table(server, f, cache_path=None):
+	"""
+		Load the DefineTable of header file f of server server, see
+		headerparser.load_define_table
+	"""
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(None, headerparser.load_define_table, server, f, cache_path)
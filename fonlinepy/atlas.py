@@ -0,0 +1,115 @@
+"""
+
+	Rectangle packing for texture atlases
+
+	Uses the skyline bottom-left algorithm: each page keeps the top edge
+	('skyline') of the packed rectangles as a list of horizontal segments,
+	and each rectangle is placed where its bottom edge is the lowest.
+
+"""
+
+class SkylinePacker:
+	def __init__(self, width, height):
+		"""
+			Packer for a single page of size width x height
+		"""
+		self.width = width
+		self.height = height
+		self.skyline = [[0, 0, width]] # segments as [x, y, width], sorted by x
+
+	def _fit(self, i, w, h):
+		"""
+			Get the y at which a w x h rectangle fits at the start of segment
+			i, or None if it doesn't fit
+		"""
+		sky = self.skyline
+		x = sky[i][0]
+		if x + w > self.width:
+			return None
+		y = 0
+		width_left = w
+		while width_left > 0:
+			y = max(y, sky[i][1])
+			if y + h > self.height:
+				return None
+			width_left -= sky[i][2]
+			i += 1
+		return y
+
+	def insert(self, w, h):
+		"""
+			Place a w x h rectangle. Returns its (x, y) or None if it doesn't
+			fit the page.
+		"""
+		sky = self.skyline
+		best = None
+		best_bottom = best_width = None
+		for i in range(len(sky)):
+			y = self._fit(i, w, h)
+			if y is None:
+				continue
+			bottom = y + h
+			if best is None or bottom < best_bottom or (bottom == best_bottom and sky[i][2] < best_width):
+				best = (i, y)
+				best_bottom = bottom
+				best_width = sky[i][2]
+		if best is None:
+			return None
+
+		i, y = best
+		x = sky[i][0]
+		sky.insert(i, [x, y + h, w])
+
+		# Shrink or remove the segments covered by the new one
+		j = i + 1
+		while j < len(sky):
+			prev_end = sky[j - 1][0] + sky[j - 1][2]
+			if sky[j][0] >= prev_end:
+				break
+			shrink = prev_end - sky[j][0]
+			sky[j][0] += shrink
+			sky[j][2] -= shrink
+			if sky[j][2] > 0:
+				break
+			del sky[j]
+
+		# Merge neighbouring segments at the same height
+		j = max(i, 1)
+		while j < len(sky):
+			if sky[j - 1][1] == sky[j][1]:
+				sky[j - 1][2] += sky[j][2]
+				del sky[j]
+			else:
+				j += 1
+		return x, y
+
+def pack_rects(sizes, page_width, page_height, padding=0):
+	"""
+		Pack rectangles of (width, height) sizes into as few pages as
+		possible. Returns list of (page, x, y) positions in the order of
+		sizes. Rectangles are separated by 'padding' pixels. Empty rectangles
+		are placed at (0, 0, 0).
+	"""
+	positions = [None] * len(sizes)
+	order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+	pages = []
+	for i in order:
+		w, h = sizes[i]
+		if w == 0 or h == 0:
+			positions[i] = (0, 0, 0)
+			continue
+		w += padding
+		h += padding
+		if w > page_width or h > page_height:
+			raise RuntimeError("Rectangle of size {}x{} doesn't fit into a {}x{} page".format(
+				sizes[i][0], sizes[i][1], page_width, page_height))
+		for page, packer in enumerate(pages):
+			pos = packer.insert(w, h)
+			if pos is not None:
+				break
+		else:
+			page = len(pages)
+			pages.append(SkylinePacker(page_width, page_height))
+			pos = pages[-1].insert(w, h)
+		positions[i] = (page, pos[0], pos[1])
+	return positions
@@ -1,10 +1,13 @@
+import os
+import mmap
 import struct
 
 """
 
 	Fallout FRM file parser
 	
-	Doesn't support palettes!
+	Frames contain palette indices. Use fonlinepy.palette to load the palette
+	and the decode_* functions (requiring numpy) to convert frames to RGBA.
 	
 """
 
@@ -23,7 +26,7 @@ def parse_frm_header(data):
 		raise RuntimeError("Unknown FRM version {}".format(ver))
 	
 	offsets = struct.unpack(">hhhhhhhhhhhh", data[0x0A:0x22])
-	offsets = zip(offsets[0:6], offsets[6:12])
+	offsets = list(zip(offsets[0:6], offsets[6:12]))
 	
 	direction_offsets = struct.unpack(">IIIIII", data[0x22:0x3A])
 	
@@ -74,31 +77,200 @@ def parse_frm(data):
 		proc_offs[orig_off] = images
 		direction_images.append(images)
 	return header, direction_images
+
+class FrmFile:
+	FRAME_AREA_START = 0x03E
+	
+	def __init__(self, data):
+		"""
+			Lazily parsed FRM file. Only the header is parsed when created,
+			the frame offsets of a direction are read when the direction is
+			first accessed and frames are parsed on access.
+			
+			data can be any buffer (bytes, mmap...). The pixels of the frames
+			are memoryview slices of it, no frame data is copied.
+		"""
+		self._mmap = None
+		self.data = memoryview(data)
+		try:
+			self.header = parse_frm_header(self.data)
+		except:
+			self.data.release()
+			raise
+		self.fps = self.header["fps"]
+		self.num_frames = self.header["num_frames"]
+		self.shifts = self.header["shifts"]
+		self._frame_offsets = {} # direction byte offset -> list of frame offsets
+
+	@classmethod
+	def open(cls, path):
+		"""
+			Open FRM file by memory-mapping it. The file should be closed with
+			close() once its frames are no longer used.
+		"""
+		with open(path, "rb") as f:
+			try:
+				m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				# Empty files can't be mapped
+				raise RuntimeError("Invalid FRM header")
+		try:
+			frm = cls(m)
+		except:
+			m.close()
+			raise
+		frm._mmap = m
+		return frm
+
+	def close(self):
+		"""
+			Release the data. If views of it, such as the pixels of frames, are still
+			referenced, the file stays mapped until they are garbage collected.
+		"""
+		self.data.release()
+		if self._mmap is not None:
+			try:
+				self._mmap.close()
+			except BufferError:
+				# The mapping is closed when the last view is released
+				pass
+			self._mmap = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def frame_offsets(self, direction):
+		"""
+			Get list of byte offsets of the frames of direction
+		"""
+		dir_off = self.header["direction_byte_offsets"][direction]
+		offs = self._frame_offsets.get(dir_off)
+		if offs is not None:
+			return offs
+		
+		offs = []
+		off = self.FRAME_AREA_START + dir_off
+		for i in range(0, self.num_frames):
+			if off + 0x0C > len(self.data):
+				raise RuntimeError("Truncated FRM frame data")
+			size = struct.unpack_from(">I", self.data, off + 4)[0]
+			offs.append(off)
+			off += 0x0C + size
+		if off > len(self.data):
+			raise RuntimeError("Truncated FRM frame data")
+		self._frame_offsets[dir_off] = offs
+		return offs
+
+	def frame(self, direction, index):
+		"""
+			Parse frame 'index' of 'direction', see parse_frame_data
+		"""
+		return parse_frame_data(self.data, self.frame_offsets(direction)[index])
+
+	def direction(self, direction):
+		"""
+			Parse all frames of 'direction'
+		"""
+		return [parse_frame_data(self.data, x) for x in self.frame_offsets(direction)]
+
+	def unique_directions(self):
+		"""
+			Get list of the directions with their own frames. Directions
+			sharing their frames with a previous direction are left out.
+		"""
+		seen = set()
+		result = []
+		for d, off in enumerate(self.header["direction_byte_offsets"]):
+			if off not in seen:
+				seen.add(off)
+				result.append(d)
+		return result
+
+def find_frm_files(folder):
+	"""
+		Get sorted list of paths of FRM files in folder and its subfolders
+	"""
+	result = []
+	for dirpath, dirnames, filenames in os.walk(folder):
+		for x in filenames:
+			if x.lower().endswith(".frm"):
+				result.append(os.path.join(dirpath, x))
+	return sorted(result)
+
+def _rgba_lut(palette):
+	import numpy as np
+	# One 32-bit RGBA value per index, so that decoding is a single gather
+	return np.frombuffer(palette.rgba_table(), dtype=np.uint32)
+
+def decode_frame_rgba(frame, palette):
+	"""
+		Decode a parsed frame into a (height, width, 4) numpy array of RGBA
+		colors using a fonlinepy.palette.Palette
+	"""
+	import numpy as np
+	indices = np.frombuffer(frame["pixels"], dtype=np.uint8)
+	rgba = _rgba_lut(palette)[indices].view(np.uint8)
+	return rgba.reshape(frame["height"], frame["width"], 4)
+
+def decode_frames_rgba(frames, palette):
+	"""
+		Decode a list of parsed frames into a list of (height, width, 4) RGBA
+		arrays. The pixels of all frames are stacked into a single buffer and
+		decoded with one palette lookup.
+	"""
+	import numpy as np
+	if len(frames) == 0:
+		return []
+	indices = np.frombuffer(b"".join(x["pixels"] for x in frames), dtype=np.uint8)
+	rgba = _rgba_lut(palette)[indices].view(np.uint8).reshape(-1, 4)
+	result = []
+	pos = 0
+	for x in frames:
+		size = x["width"] * x["height"]
+		result.append(rgba[pos:pos+size].reshape(x["height"], x["width"], 4))
+		pos += size
+	return result
+
+def decode_frm_rgba(frm, palette):
+	"""
+		Decode all frames of FrmFile frm into RGBA arrays in one batch.
+		Returns list of six directions, each a list of frame arrays.
+		Directions sharing frames share the decoded arrays as well.
+	"""
+	unique = frm.unique_directions()
+	frames = []
+	for d in unique:
+		frames.extend(frm.direction(d))
+	decoded = decode_frames_rgba(frames, palette)
+	
+	by_offset = {}
+	for i, d in enumerate(unique):
+		off = frm.header["direction_byte_offsets"][d]
+		by_offset[off] = decoded[i * frm.num_frames:(i + 1) * frm.num_frames]
+	return [by_offset[x] for x in frm.header["direction_byte_offsets"]]
+
 testim = None
 
 if __name__ == "__main__":
 	"""
-		Test program, loads and displays a FRM file (without correct palette).
+		Test program, loads and displays a FRM file. Uses a grayscale palette
+		unless color.pal is given with --palette.
 		Requires numpy and matplotlib
 	"""
-	import numpy as np
 	import matplotlib.pyplot as plt
 	import argparse
+	import fonlinepy.palette as palette
 	parser = argparse.ArgumentParser(description="FRM test program")
 	parser.add_argument("input", type=str)
+	parser.add_argument("--palette", type=str, help="path to color.pal")
 	args = parser.parse_args()
 	ifile = args.input
-	
+	pal = palette.Palette.load(args.palette) if args.palette else palette.Palette.grayscale()
 
-	with open(ifile, "rb") as f:
-		b = f.read()
-		data = parse_frm(b)
-		tim = data[1][0][0]
-		arr = np.frombuffer(tim["pixels"], dtype=np.uint8)
-		arr = np.reshape(arr, [tim["height"], tim["width"]])
-		testim = arr
-		plt.imshow(arr)
+	with FrmFile.open(ifile) as frm:
+		testim = decode_frame_rgba(frm.frame(0, 0), pal)
+		plt.imshow(testim)
 		plt.show()
-		
-
-
@@ -1,36 +1,49 @@
 import re, ast
+import os
+import hashlib
+import logging
+import marshal
+import tempfile
+import fonlinepy.profiling as profiling
 
 """
 
 	Used to parse C/C++ header files for preprocessor defines.
 
+	DefineTable follows the #includes of a header and resolves defines
+	referring to other defines, such as '#define A (B | C)', by evaluating
+	simple arithmetic and bitwise expressions in dependency order.
+
 """
 
+_define_regex = re.compile(r'\s*\#\s*define\s+([^\s]+)(.*)$')
+_include_regex = re.compile(r'\s*\#\s*include\s+["<]([^">]+)[">]')
+_int_suffix_regex = re.compile(r'\b(0[xX][0-9a-fA-F]+|\d+)[uUlL]+\b')
 
-def parse_header(lines):
-	
-	define_regex = re.compile(r'\s*\#\s*define\s+([^\s]+)(.*)$')
+def _define_value(def_val):
+	def_val = def_val.split("//")[0]
+	return def_val.strip()
 
-	is_none = lambda x: not x is None
-	
-	lines = map(define_regex.match, lines)
-	lines = filter(is_none, lines)
-
-	for l in lines:
-		def_name = l.group(1)
-		def_val = l.group(2)
-		def_val = def_val.split("//")[0]
-		value = None
-		def_val = def_val.strip()
-		if len(def_val) == 0:
-			value = ""
-		else:
-			#print (def_val)
-			try:
-				value = ast.literal_eval(def_val)
-			except:
-				pass
-		yield (def_name, value)
+def parse_header_raw(lines):
+	"""
+		Generate (name, value text) pairs of the defines in lines
+	"""
+	for line in lines:
+		l = _define_regex.match(line)
+		if l is not None:
+			yield (l.group(1), _define_value(l.group(2)))
+
+def _literal(def_val):
+	if len(def_val) == 0:
+		return ""
+	try:
+		return ast.literal_eval(def_val)
+	except:
+		return None
+
+def parse_header(lines):
+	for def_name, def_val in parse_header_raw(lines):
+		yield (def_name, _literal(def_val))
 
 def parse_header_file(server, f):
 	import os
@@ -39,37 +52,350 @@ def parse_header_file(server, f):
 		yield l
 
 
+class DefineClassifier:
+	def __init__(self, families):
+		"""
+			Classifier of define names into families by name prefix.
+			families is a list of (family, prefix, strip) tuples; strip tells
+			if the prefix is removed from the classified define names. A name
+			matching several prefixes belongs to the family of the longest.
+		"""
+		self.families = list(families)
+		self._trie = {} # character -> child node, None -> (family, prefix length, strip)
+		for family, prefix, strip in self.families:
+			node = self._trie
+			for c in prefix:
+				node = node.setdefault(c, {})
+			node[None] = (family, len(prefix), strip)
+
+	def classify(self, name):
+		"""
+			Get (family, classified name) of define name, or None if no
+			prefix matches
+		"""
+		node = self._trie
+		match = node.get(None)
+		for c in name:
+			node = node.get(c)
+			if node is None:
+				break
+			match = node.get(None, match)
+		if match is None:
+			return None
+		family, length, strip = match
+		return family, name[length:] if strip else name
+
+	def classify_all(self, defines):
+		"""
+			Classify dictionary of defines (define name -> value). Returns a
+			DefineClassification.
+		"""
+		result = DefineClassification(f[0] for f in self.families)
+		for k, v in defines.items():
+			match = self.classify(k)
+			if match is None:
+				continue
+			family, name = match
+			reverse = result.reverse[family]
+			if v in reverse:
+				result.duplicates.append((family, v, reverse[v], name))
+				continue
+			reverse[v] = name
+			result.names[family][name] = v
+		return result
+
+class DefineClassification:
+	def __init__(self, families):
+		families = list(families)
+		self.reverse = dict((x, {}) for x in families) # family -> {value -> classified name}
+		self.names = dict((x, {}) for x in families) # family -> {classified name -> value}
+		self.duplicates = [] # (family, value, kept name, ignored name) of values defined more than once
+
+# Item define families. Longer prefixes win, so ITEM_ only gets the
+# remaining item flags.
+ITEM_FAMILIES = [
+	("item_data", "ITEM_DATA_", False),
+	("item_events", "ITEM_EVENT_", False),
+	("item_perks", "ITEM_PERK_", False),
+	("item_types", "ITEM_TYPE_", False),
+	("item_flags", "ITEM_", True) #store item flags without the "ITEM_" prefix
+]
+
+_item_classifier = DefineClassifier(ITEM_FAMILIES)
+
+def classify_item_defines(defines):
+	"""
+		Classify the item defines of dictionary defines (define name ->
+		value) into ITEM_FAMILIES. Returns DefineClassification, whose
+		duplicates are left for the caller to report.
+	"""
+	return _item_classifier.classify_all(defines)
+
+def describe_duplicate(duplicate):
+	"""
+		Get message describing entry of DefineClassification.duplicates of
+		item defines
+	"""
+	family, v, kept, ignored = duplicate
+	prefix = dict((x[0], x[1]) for x in ITEM_FAMILIES)[family]
+	return "Duplicate {} definition for value {} ({} and {}). Ignoring the latter".format(prefix, v, kept, ignored)
+
 def get_item_flags(defines):
 	"""
 		From dictionary of defines (define name -> value)
-		get item flags and such
+		get item flags and such. Duplicates are logged as warnings, use
+		classify_item_defines to get them.
 	"""
-	import sys
-	
+	result = classify_item_defines(defines)
+	for x in result.duplicates:
+		logging.warning(describe_duplicate(x))
+	return result.reverse
 	
-	# list of things to find and their associated define prefixes.
-	# The boolean value is whether the define name should be stripped of the prefix
-	dict_pairs = [
-		("item_data", "ITEM_DATA_", False),
-		("item_events", "ITEM_EVENT_", False),
-		("item_perks", "ITEM_PERK_", False),
-		("item_types", "ITEM_TYPE_", False),
-		("item_flags", "ITEM_", True) #store item flags without the "ITEM_" prefix
-	]
-	dctt = dict((x, {}) for x, _, _ in dict_pairs)
-	for k, v in defines.items():
-		for ttype, tprefix, tstrip in dict_pairs:
-			
-			if k.startswith(tprefix):
-				if tstrip:
-					k = k[len(tprefix):]
-				if v in dctt[ttype]:
-					print("Duplicate {} definition for value {} ({} and {}). Ignoring the latter".format(tprefix, v, dctt[ttype][v], k), file=sys.stderr)
+class _Unresolved(Exception):
+	pass
+
+_binary_ops = {
+	ast.Add: lambda a, b: a + b,
+	ast.Sub: lambda a, b: a - b,
+	ast.Mult: lambda a, b: a * b,
+	ast.Div: lambda a, b: int(a / b) if isinstance(a, int) and isinstance(b, int) else a / b,
+	ast.FloorDiv: lambda a, b: a // b,
+	ast.Mod: lambda a, b: a % b,
+	ast.LShift: lambda a, b: a << b,
+	ast.RShift: lambda a, b: a >> b,
+	ast.BitOr: lambda a, b: a | b,
+	ast.BitAnd: lambda a, b: a & b,
+	ast.BitXor: lambda a, b: a ^ b,
+}
+
+_unary_ops = {
+	ast.USub: lambda a: -a,
+	ast.UAdd: lambda a: +a,
+	ast.Invert: lambda a: ~a,
+}
+
+def _compile_expression(def_val):
+	"""
+		Parse the value text of a define into an expression. Returns
+		(expression, names of referred defines), or None if the text is not
+		a supported expression.
+	"""
+	try:
+		expr = ast.parse(_int_suffix_regex.sub(r"\1", def_val), mode="eval").body
+	except (SyntaxError, ValueError):
+		return None
+	names = []
+	for node in ast.walk(expr):
+		if isinstance(node, ast.Name):
+			names.append(node.id)
+		elif not isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Constant, ast.Load, ast.operator, ast.unaryop)):
+			return None
+	return expr, names
+
+def _evaluate(node, values):
+	if isinstance(node, ast.Constant):
+		return node.value
+	if isinstance(node, ast.Name):
+		value = values.get(node.id)
+		if value is None:
+			raise _Unresolved(node.id)
+		return value
+	if isinstance(node, ast.BinOp):
+		op = _binary_ops.get(type(node.op))
+		if op is None:
+			raise _Unresolved()
+		return op(_evaluate(node.left, values), _evaluate(node.right, values))
+	if isinstance(node, ast.UnaryOp):
+		op = _unary_ops.get(type(node.op))
+		if op is None:
+			raise _Unresolved()
+		return op(_evaluate(node.operand, values))
+	raise _Unresolved()
+
+def evaluate_expression(text, values):
+	"""
+		Evaluate arithmetic or bitwise expression text referring to the
+		defines in dictionary values (define name -> value)
+	"""
+	compiled = _compile_expression(text)
+	if compiled is None:
+		raise RuntimeError("Invalid expression {}".format(text))
+	try:
+		return _evaluate(compiled[0], values)
+	except _Unresolved as e:
+		raise RuntimeError("Unresolved define {} in expression {}".format(e, text) if e.args else "Invalid expression {}".format(text))
+	except (TypeError, ValueError, ArithmeticError) as e:
+		raise RuntimeError("Failed to evaluate expression {}: {}".format(text, e))
+
+def resolve_defines(raw_defines):
+	"""
+		Get dictionary of define values from (name, value text) pairs.
+		Defines referring to other defines are evaluated after their
+		dependencies. Values that can't be resolved are None.
+	"""
+	values = {}
+	expressions = {}
+	for name, def_val in raw_defines:
+		value = _literal(def_val)
+		if value is None and len(def_val) > 0:
+			compiled = _compile_expression(def_val)
+			if compiled is not None:
+				# Keep the define in file order, the value is set once resolved
+				expressions[name] = compiled
+				values[name] = None
+				continue
+		values[name] = value
+		expressions.pop(name, None)
+
+	# Depth first traversal of the dependencies, evaluating each define
+	# after all the defines it refers to. Cyclic references are unresolved.
+	state = {}
+	for root in expressions:
+		if root in state:
+			continue
+		state[root] = False
+		stack = [(root, iter(expressions[root][1]))]
+		while stack:
+			name, deps = stack[-1]
+			for dep in deps:
+				if dep in expressions and dep not in state:
+					state[dep] = False
+					stack.append((dep, iter(expressions[dep][1])))
+					break
+			else:
+				stack.pop()
+				state[name] = True
+				try:
+					values[name] = _evaluate(expressions[name][0], values)
+				except (_Unresolved, TypeError, ValueError, ArithmeticError):
+					values[name] = None
+	return values
+
+def read_header_files(path, encoding=None):
+	"""
+		Get (name, value text) pairs of the defines of the header file at
+		path and the files it includes, and list of (path, mtime, size) of
+		the read files, taken before reading them. Included paths are
+		relative to the including file.
+	"""
+	raw_defines = []
+	files = []
+	seen = set()
+	def read(path):
+		path = os.path.normpath(path)
+		if path in seen:
+			return
+		seen.add(path)
+		with open(path, encoding=encoding, errors='ignore') as f:
+			st = os.fstat(f.fileno())
+			files.append((path, st.st_mtime_ns, st.st_size))
+			for line in f:
+				m = _define_regex.match(line)
+				if m is not None:
+					raw_defines.append((m.group(1), _define_value(m.group(2))))
 					continue
-				dctt[ttype][v] = k
-				break
-	return dctt
-	
+				m = _include_regex.match(line)
+				if m is not None:
+					include_path = os.path.join(os.path.dirname(path), m.group(1))
+					try:
+						read(include_path)
+					except OSError as e:
+						logging.warning("Failed to read included file %s: %s", include_path, e)
+	read(path)
+	return raw_defines, files
+
+CACHE_VERSION = 1
+
+def _file_stamps(files):
+	stamps = []
+	for path in files:
+		st = os.stat(path)
+		stamps.append((path, st.st_mtime_ns, st.st_size))
+	return tuple(stamps)
+
+class DefineTable:
+	def __init__(self, path):
+		"""
+			Resolved defines of the header file at path and its includes
+		"""
+		self.path = path
+		self.values = {} # define name -> value, None if unresolved
+		self.files = () # (path, mtime, size) of the read files
+
+	def is_modified(self):
+		"""
+			Check if any of the read files has been modified since loading
+		"""
+		try:
+			return _file_stamps(f[0] for f in self.files) != self.files
+		except OSError:
+			return True
+
+	def _cache_entry_path(self, cache_path):
+		key = hashlib.sha1(os.path.abspath(self.path).encode("utf-8", "surrogateescape")).hexdigest()
+		return os.path.join(cache_path, key + ".fdc")
+
+	def load(self, cache_path=None):
+		"""
+			Read and resolve the defines. If cache_path is given, the result
+			is loaded from the cache directory when none of the files has
+			been modified, and stored in it otherwise.
+		"""
+		if cache_path:
+			with profiling.span("define_cache_load", self.path):
+				if self._load_cache(cache_path):
+					return self
+		with profiling.span("read_defines", self.path):
+			raw_defines, files = read_header_files(self.path)
+			self.files = tuple(files)
+		with profiling.span("resolve_defines", self.path):
+			self.values = resolve_defines(raw_defines)
+		profiling.count("defines", len(self.values))
+		if cache_path:
+			self._store_cache(cache_path)
+		return self
+
+	def _load_cache(self, cache_path):
+		try:
+			with open(self._cache_entry_path(cache_path), "rb") as f:
+				entry = marshal.loads(f.read())
+		except OSError:
+			return False
+		except (EOFError, ValueError, TypeError):
+			logging.warning("Ignoring corrupted define cache for %s", self.path)
+			return False
+		if not isinstance(entry, tuple) or len(entry) != 4:
+			return False
+		version, path, files, values = entry
+		if version != CACHE_VERSION or path != os.path.abspath(self.path):
+			return False
+		self.files = files
+		if self.is_modified():
+			return False
+		self.values = values
+		return True
+
+	def _store_cache(self, cache_path):
+		try:
+			data = marshal.dumps((CACHE_VERSION, os.path.abspath(self.path), self.files, self.values))
+			os.makedirs(cache_path, exist_ok=True)
+			fd, tmp_path = tempfile.mkstemp(dir=cache_path, suffix=".tmp")
+			try:
+				with os.fdopen(fd, "wb") as f:
+					f.write(data)
+				os.replace(tmp_path, self._cache_entry_path(cache_path))
+			except BaseException:
+				os.unlink(tmp_path)
+				raise
+		except (OSError, ValueError) as e:
+			logging.warning("Failed to write define cache for %s: %s", self.path, e)
+
+def load_define_table(server, f, cache_path=None):
+	"""
+		Load the DefineTable of header file f of server server
+	"""
+	return DefineTable(os.path.join(server, f)).load(cache_path)
+
 if __name__ == "__main__":
 	import sys
 	for m in parse_header(sys.stdin):
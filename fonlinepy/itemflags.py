@@ -0,0 +1,96 @@
+"""
+
+	Precompiled item flag tables
+
+	ItemFlags holds the item define families returned by
+	headerparser.get_item_flags and compiles the item flags into a map of
+	flag names to values and, for each byte of a Flags value, a lookup table
+	giving the names of the flags set in that byte. Expanding names into a
+	value and decomposing a value into names are memoized.
+
+"""
+
+ITEM_PREFIX = "ITEM_"
+
+class ItemFlags(dict):
+	def __init__(self, defines, families):
+		"""
+			Compile the item flags. defines is the dictionary of defines
+			(define name -> value), families the dictionary returned by
+			headerparser.get_item_flags.
+		"""
+		super().__init__(families)
+		# Any ITEM_ define can be used in $iflags, not only the flags
+		self.bits = dict((k[len(ITEM_PREFIX):], v) for k, v in defines.items()
+			if k.startswith(ITEM_PREFIX) and isinstance(v, int) and not isinstance(v, bool))
+
+		flags = dict((v, name) for v, name in families["item_flags"].items()
+			if isinstance(v, int) and v > 0 and v & (v - 1) == 0)
+		byte_count = max(v.bit_length() for v in flags) // 8 + 1 if flags else 0
+		self._tables = [] # per byte: 256 tuples of the names of the flags set in the byte
+		self._missing = [] # per byte: mask of the bits without a flag
+		for k in range(byte_count):
+			names = [flags.get(1 << (8 * k + i)) for i in range(8)]
+			table = [()] * 256
+			for b in range(1, 256):
+				low = b & -b
+				i = low.bit_length() - 1
+				table[b] = ((names[i],) if names[i] is not None else ()) + table[b & ~low]
+			self._tables.append(table)
+			self._missing.append(sum(1 << i for i in range(8) if names[i] is None))
+		self._expanded = {}
+		self._decomposed = {}
+
+	def expand(self, names):
+		"""
+			Get the value of string of space separated flag names without the
+			ITEM_ prefix
+		"""
+		value = self._expanded.get(names)
+		if value is None:
+			value = 0
+			for name in names.split():
+				bit = self.bits.get(name)
+				if bit is None:
+					raise RuntimeError("Unknown item flag {}".format(ITEM_PREFIX + name))
+				value |= bit
+			self._expanded[names] = value
+		return value
+
+	def decompose(self, value):
+		"""
+			Get tuple of the names of the flags set in value, lowest bit
+			first. Values up to 0 have no flags.
+		"""
+		names = self._decomposed.get(value)
+		if names is None:
+			names = ()
+			k = 0
+			v = value
+			while v > 0:
+				b = v & 0xFF
+				if b:
+					missing = b & self._missing[k] if k < len(self._tables) else b
+					if missing:
+						raise RuntimeError("No item flag found for value bit {}".format((missing & -missing) << (8 * k)))
+					names += self._tables[k][b]
+				v >>= 8
+				k += 1
+			self._decomposed[value] = names
+		return names
+
+	def expand_column(self, column):
+		"""
+			Expand a column of flag name strings, as in expand. Returns list
+			of values.
+		"""
+		expand = self.expand
+		return [expand(x) for x in column]
+
+	def decompose_column(self, column):
+		"""
+			Decompose a column of values, as in decompose. Returns list of
+			name tuples; each distinct value is decomposed once.
+		"""
+		decompose = self.decompose
+		return [decompose(x) for x in column]
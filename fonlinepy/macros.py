@@ -0,0 +1,183 @@
+import fonlinepy.headerparser as headerparser
+
+"""
+
+	Macro engine for proto field values
+
+	Macros are field values starting with '$' followed by the macro name
+	and its arguments, such as '$def ITEM_TYPE_WEAPON'. MacroEngine looks up
+	the macro expanding a value by its name and the reverse rules turning a
+	value back into a macro by the field key, so fields without macros or
+	rules are skipped with a single check.
+
+	Standard macros:
+
+	- $def DEFINE_NAME
+		Value of the define DEFINE_NAME
+	- $iflags FLAG1 FLAG2 FLAG3
+		Bitwise or combination of ITEM_* flags, without the 'ITEM_' prefix
+	- $pid NAME
+		Value of the define PID_NAME (or NAME if it already has the prefix)
+	- $expr EXPRESSION
+		Value of an arithmetic or bitwise expression of defines, such as
+		'$expr ITEM_HIDDEN | ITEM_FLAT'
+	- $msg FILE NUMBER
+		Text of message NUMBER of string table FILE, such as
+		'$msg FOOBJ 1200'. NUMBER can also be a define. Needs the string
+		tables of the engine.
+
+	Standard reverse rules turn the Flags field into $iflags and the Type
+	field into $def.
+
+"""
+
+PID_PREFIX = "PID_"
+
+class MacroEngine:
+	def __init__(self, defines, iflags, strings=None):
+		"""
+			Engine without macros or rules. defines is the dictionary of
+			defines (define name -> value), iflags the compiled
+			itemflags.ItemFlags. strings is the dictionary of string tables
+			(upper case MSG file name -> msgcorpus.MsgTable) of a language,
+			such as MsgCorpus.tables["engl"].
+		"""
+		self.defines = defines
+		self.iflags = iflags
+		self.strings = strings
+		self.macros = {} # lower case macro name -> function(engine, arguments)
+		self.reverse_rules = {} # field key -> list of function(engine, value)
+
+	def register_macro(self, name, func):
+		"""
+			Register func(engine, arguments) expanding macro $name. It returns
+			the new field value.
+		"""
+		self.macros[name.lower()] = func
+
+	def register_reverse(self, key, func):
+		"""
+			Register func(engine, value) converting values of field key into
+			macros. It returns the new field value, or None if it doesn't
+			apply. Rules are tried in the registration order.
+		"""
+		self.reverse_rules.setdefault(key, []).append(func)
+
+	def expand(self, key, value):
+		"""
+			Expand the macro of proto key-value pair. Returns the new value or
+			None if the value is not a macro.
+		"""
+		if not value.startswith("$"):
+			return None
+		parts = value[1:].split(None, 1)
+		if len(parts) < 2:
+			return None
+		func = self.macros.get(parts[0].lower())
+		if func is None:
+			return None
+		return func(self, parts[1].strip())
+
+	def reverse(self, key, value):
+		"""
+			Convert proto key-value pair into a macro. Returns the new value or
+			None if no rule applies.
+		"""
+		rules = self.reverse_rules.get(key)
+		if rules is None:
+			return None
+		for func in rules:
+			result = func(self, value)
+			if result is not None:
+				return result
+		return None
+
+	def define(self, name):
+		if name not in self.defines:
+			raise RuntimeError("Unknown define {}".format(name))
+		value = self.defines[name]
+		if value is None:
+			raise RuntimeError("Unresolved define {}".format(name))
+		return value
+
+	def string(self, file_name, num):
+		"""
+			Get the text of message num of string table file_name. The
+			'.MSG' extension of file_name is optional.
+		"""
+		if self.strings is None:
+			raise RuntimeError("No string tables loaded")
+		file_name = file_name.upper()
+		if not file_name.endswith(".MSG"):
+			file_name += ".MSG"
+		table = self.strings.get(file_name)
+		if table is None:
+			raise RuntimeError("Unknown string table {}".format(file_name))
+		text = table.get(num)
+		if text is None:
+			raise RuntimeError("No message {} in {}".format(num, file_name))
+		if "\n" in text:
+			raise RuntimeError("Message {} in {} spans several lines".format(num, file_name))
+		return text
+
+def macro_def(engine, args):
+	return engine.define(args.split()[0])
+
+def macro_iflags(engine, args):
+	return str(engine.iflags.expand(args))
+
+def macro_pid(engine, args):
+	name = args.split()[0]
+	if not name.startswith(PID_PREFIX):
+		name = PID_PREFIX + name
+	return str(engine.define(name))
+
+def macro_expr(engine, args):
+	return str(headerparser.evaluate_expression(args, engine.defines))
+
+def macro_msg(engine, args):
+	parts = args.split()
+	if len(parts) < 2:
+		raise RuntimeError("Expected '$msg FILE NUMBER'")
+	try:
+		num = int(parts[1], 0)
+	except ValueError:
+		num = engine.define(parts[1])
+		if not isinstance(num, int):
+			raise RuntimeError("Define {} is not a message number".format(parts[1]))
+	return engine.string(parts[0], num)
+
+def reverse_flags(engine, value):
+	try:
+		value = int(value)
+	except ValueError:
+		# Failed to parse value as integer
+		return None
+	flags = engine.iflags.decompose(value)
+	if len(flags) > 0:
+		return "$iflags " + " ".join(flags)
+	return None
+
+def reverse_type(engine, value):
+	try:
+		value = int(value)
+	except ValueError:
+		return None
+	if value in engine.iflags["item_types"]:
+		return "$def " + engine.iflags["item_types"][value]
+	return None
+
+def standard_engine(defines, iflags, strings=None):
+	"""
+		Get MacroEngine with the standard macros and reverse rules, see
+		MacroEngine for strings
+	"""
+	engine = MacroEngine(defines, iflags, strings)
+	engine.register_macro("def", macro_def)
+	engine.register_macro("iflags", macro_iflags)
+	engine.register_macro("pid", macro_pid)
+	engine.register_macro("expr", macro_expr)
+	engine.register_macro("msg", macro_msg)
+	engine.register_reverse("Flags", reverse_flags)
+	engine.register_reverse("Type", reverse_type)
+	return engine
@@ -0,0 +1,244 @@
+import os
+import bisect
+import marshal
+import logging
+import tempfile
+import concurrent.futures
+import fonlinepy.msgfile as msgfile
+from array import array
+
+"""
+
+	MSG files of all languages of a server
+
+	Loads the .msg files of every language folder in the server text folder
+	(text/engl, text/russ...). The messages of each file are kept in a
+	MsgTable: a sorted array of message numbers and a list of texts in the
+	same order, searched with bisection.
+
+	The loaded tables can be stored in a cache file. Files whose modification
+	time and size match the cache, and which were decoded with the same
+	encoding, are not parsed again.
+
+"""
+
+TEXT_PATH = "text"
+CACHE_VERSION = 2
+
+class MsgTable:
+	__slots__ = ("numbers", "texts")
+
+	def __init__(self, numbers, texts):
+		self.numbers = numbers # sorted array of message numbers
+		self.texts = texts # texts in the order of self.numbers
+
+	@classmethod
+	def from_msg_file(cls, msg):
+		"""
+			Create table from a MsgFile. Only the first definition of a
+			message number is kept.
+		"""
+		entries = sorted((num, i) for num, i in msg.index.items())
+		numbers = array("q", (num for num, i in entries))
+		texts = [msg.text(num) for num in numbers]
+		return cls(numbers, texts)
+
+	def __len__(self):
+		return len(self.numbers)
+
+	def __contains__(self, num):
+		i = bisect.bisect_left(self.numbers, num)
+		return i < len(self.numbers) and self.numbers[i] == num
+
+	def get(self, num, default=None):
+		i = bisect.bisect_left(self.numbers, num)
+		if i < len(self.numbers) and self.numbers[i] == num:
+			return self.texts[i]
+		return default
+
+	def range(self, first, last):
+		"""
+			Get list of (number, text) of messages first <= number <= last
+		"""
+		i = bisect.bisect_left(self.numbers, first)
+		j = bisect.bisect_right(self.numbers, last)
+		return list(zip(self.numbers[i:j], self.texts[i:j]))
+
+def _load_table(path, encoding):
+	st = os.stat(path)
+	with msgfile.MsgFile.open(path, encoding) as msg:
+		table = MsgTable.from_msg_file(msg)
+	return st.st_mtime_ns, st.st_size, table.numbers.tobytes(), table.texts
+
+class MsgCorpus:
+	def __init__(self):
+		self.tables = {} # language -> {upper case file name -> MsgTable}
+		self._stamps = {} # (language, file name) -> (path, mtime, size, encoding)
+		self._text_path = None
+
+	def languages(self):
+		return sorted(self.tables)
+
+	def files(self, language):
+		return sorted(self.tables.get(language, {}))
+
+	def table(self, language, file_name):
+		return self.tables.get(language, {}).get(file_name.upper())
+
+	def text(self, language, file_name, num, default=None):
+		table = self.table(language, file_name)
+		if table is None:
+			return default
+		return table.get(num, default)
+
+	def texts(self, file_name, num):
+		"""
+			Get dictionary of the text of message num in file_name in each
+			language defining it
+		"""
+		result = {}
+		for language in self.languages():
+			text = self.text(language, file_name, num)
+			if text is not None:
+				result[language] = text
+		return result
+
+	def missing(self, file_name, language, other_language):
+		"""
+			Get list of message numbers of file_name defined in language but
+			missing in other_language
+		"""
+		a = self.table(language, file_name)
+		b = self.table(other_language, file_name)
+		if a is None:
+			return []
+		if b is None:
+			return list(a.numbers)
+		result = []
+		j = 0
+		bn = b.numbers
+		for num in a.numbers:
+			while j < len(bn) and bn[j] < num:
+				j += 1
+			if j >= len(bn) or bn[j] != num:
+				result.append(num)
+		return result
+
+	def load(self, text_path, cache_path=None, workers=None, encoding="utf-8", encodings=None, languages=None):
+		"""
+			Load the .msg files of every language folder in text_path, or of
+			the folders listed in languages if given. Files
+			are parsed in parallel by 'workers' processes. If cache_path is
+			given, unchanged files are loaded from the cache file and the
+			cache is updated afterwards. encodings can map language names
+			to encodings used instead of 'encoding'. Tables of a previous
+			load are dropped.
+		"""
+		self.tables = {}
+		self._stamps = {}
+		self._text_path = text_path
+		encodings = encodings or {}
+		cached = self._read_cache(cache_path) if cache_path else {}
+
+		to_parse = []
+		try:
+			folders = sorted(x.name for x in os.scandir(text_path)
+				if x.is_dir() and (languages is None or x.name in languages))
+		except OSError as e:
+			logging.warning("Failed to read directory '%s': %s", text_path, e)
+			folders = []
+		for language in folders:
+			lang_path = os.path.join(text_path, language)
+			self.tables[language] = {}
+			with os.scandir(lang_path) as scandir:
+				for x in scandir:
+					if not x.name.lower().endswith(".msg") or not x.is_file():
+						continue
+					key = (language, x.name.upper())
+					st = x.stat()
+					entry = cached.get(key)
+					enc = encodings.get(language, encoding)
+					if entry is not None and tuple(entry[:4]) == (x.path, st.st_mtime_ns, st.st_size, enc):
+						self._set_table(key, entry)
+					else:
+						to_parse.append((key, x.path, enc))
+
+		if len(to_parse) > 0:
+			workers = min(workers or os.cpu_count() or 1, len(to_parse))
+			if workers > 1:
+				with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+					results = list(executor.map(_load_table, [x[1] for x in to_parse], [x[2] for x in to_parse]))
+			else:
+				results = [_load_table(path, enc) for key, path, enc in to_parse]
+			for (key, path, enc), (mtime, size, numbers, texts) in zip(to_parse, results):
+				self._set_table(key, (path, mtime, size, enc, numbers, texts))
+		logging.info("Loaded %s MSG files, %s parsed", sum(len(x) for x in self.tables.values()), len(to_parse))
+
+		if cache_path and (len(to_parse) > 0 or len(cached) != len(self._stamps)):
+			self._write_cache(cache_path)
+
+	def is_modified(self):
+		"""
+			Check if any MSG file of the loaded languages has been modified,
+			added or removed since loading
+		"""
+		stamps = {}
+		try:
+			for language in self.tables:
+				with os.scandir(os.path.join(self._text_path, language)) as scandir:
+					for x in scandir:
+						if x.name.lower().endswith(".msg") and x.is_file():
+							st = x.stat()
+							stamps[(language, x.name.upper())] = (x.path, st.st_mtime_ns, st.st_size)
+		except OSError:
+			return True
+		return stamps != {key: stamp[:3] for key, stamp in self._stamps.items()}
+
+	def _set_table(self, key, entry):
+		path, mtime, size, enc, numbers, texts = entry
+		language, name = key
+		a = array("q")
+		a.frombytes(numbers)
+		self.tables[language][name] = MsgTable(a, list(texts))
+		self._stamps[key] = (path, mtime, size, enc)
+
+	def _read_cache(self, cache_path):
+		try:
+			with open(cache_path, "rb") as f:
+				data = marshal.loads(f.read())
+		except OSError:
+			return {}
+		except (EOFError, ValueError, TypeError):
+			logging.warning("Ignoring corrupted MSG cache %s", cache_path)
+			return {}
+		if not isinstance(data, tuple) or len(data) != 2 or data[0] != CACHE_VERSION:
+			return {}
+		return dict(((lang, name), entry) for lang, name, *entry in data[1])
+
+	def _write_cache(self, cache_path):
+		entries = []
+		for (language, name), (path, mtime, size, enc) in self._stamps.items():
+			table = self.tables[language][name]
+			entries.append((language, name, path, mtime, size, enc, table.numbers.tobytes(), tuple(table.texts)))
+		data = marshal.dumps((CACHE_VERSION, tuple(entries)))
+		try:
+			cache_dir = os.path.dirname(os.path.abspath(cache_path))
+			fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+			try:
+				with os.fdopen(fd, "wb") as f:
+					f.write(data)
+				os.replace(tmp_path, cache_path)
+			except BaseException:
+				os.unlink(tmp_path)
+				raise
+		except OSError as e:
+			logging.warning("Failed to write MSG cache %s: %s", cache_path, e)
+
+def load_corpus(server_path, cache_path=None, workers=None, encoding="utf-8", encodings=None, languages=None):
+	"""
+		Load the MSG files of all languages, or of the given languages, of
+		server server_path
+	"""
+	corpus = MsgCorpus()
+	corpus.load(os.path.join(server_path, TEXT_PATH), cache_path, workers, encoding, encodings, languages)
+	return corpus
@@ -1,5 +1,9 @@
 import re
-
+import mmap
+import bisect
+import logging
+import fonlinepy.profiling as profiling
+from array import array
 
 """
 	Parses Fallout MSG files
@@ -8,14 +12,169 @@ import re
 	MSG data enclosed in double quotes in CSV format.
 """
 
+# Tokens of a MSG file: whitespace, comment lines, {num}{sound}{text} triples
+# followed by the rest of their last line, and garbage lines
+_msg_token_re = re.compile(rb'''
+	(?P<ws>\s+)
+	|(?P<comment>\#[^\n]*)
+	|\{(?P<num>[^}]*)\}\s*\{(?P<sound>[^}]*)\}\s*\{(?P<text>[^}]*)\}(?P<tail>[^\n]*)
+	|(?P<garbage>[^\n]+)
+''', re.X)
+
+class MsgFile:
+	def __init__(self, data, file_name=None, encoding="utf-8"):
+		"""
+			Parses MSG data from a bytes-like object or mmap in one linear
+			scan. Only the offsets of each message are stored, the sound and
+			text are decoded when accessed.
+		"""
+		self._mmap = None
+		self.data = memoryview(data)
+		self.file_name = file_name
+		self.encoding = encoding
+		self.numbers = array("q") # message numbers in file order
+		self.offsets = array("q") # start, sound start, sound end, text start, text end of each message
+		self.index = {} # message number -> position of its first definition
+		self.duplicates = [] # numbers of messages defined more than once
+		self._newlines = None
+		self._replaced = False
+		with profiling.span("parse_msg", file_name):
+			self._scan(data)
+
+	@classmethod
+	def open(cls, path, encoding="utf-8"):
+		"""
+			Open MSG file by memory-mapping it. The file should be closed with
+			close() when no longer used.
+		"""
+		with open(path, "rb") as f:
+			try:
+				m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				# Empty files can't be mapped
+				return cls(b"", path, encoding)
+		msg = cls(m, path, encoding)
+		msg._mmap = m
+		return msg
+
+	def close(self):
+		"""
+			Release the data. If views of it, such as raw_text slices, are still
+			referenced, the file stays mapped until they are garbage collected.
+		"""
+		self.data.release()
+		if self._mmap is not None:
+			try:
+				self._mmap.close()
+			except BufferError:
+				# The mapping is closed when the last view is released
+				pass
+			self._mmap = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def _warn(self, offset):
+		if self.file_name:
+			logging.warning("Invalid MSG data at line %s in file %s", self.line_number(offset), self.file_name)
+		else:
+			logging.warning("Invalid MSG data at line %s", self.line_number(offset))
+
+	def _scan(self, data):
+		numbers = self.numbers
+		offsets = self.offsets
+		index = self.index
+		for m in _msg_token_re.finditer(data):
+			kind = m.lastgroup
+			if kind == "tail":
+				tail = m.group("tail").strip()
+				if tail and not tail.startswith(b"#"):
+					self._warn(m.start())
+					continue
+				try:
+					num = int(m.group("num"))
+				except ValueError:
+					self._warn(m.start())
+					continue
+				if num in index:
+					self.duplicates.append(num)
+				else:
+					index[num] = len(numbers)
+				numbers.append(num)
+				offsets.extend((m.start(), m.start("sound"), m.end("sound"), m.start("text"), m.end("text")))
+			elif kind == "garbage":
+				self._warn(m.start())
+
+	def line_number(self, offset):
+		"""
+			Get the line number (starting from 1) of the byte offset
+		"""
+		if self._newlines is None:
+			self._newlines = array("q", (m.start() for m in re.finditer(rb"\n", self.data)))
+		return bisect.bisect_left(self._newlines, offset) + 1
+
+	def __len__(self):
+		return len(self.numbers)
+
+	def __contains__(self, num):
+		return num in self.index
+
+	def _decode(self, start, end):
+		try:
+			s = str(self.data[start:end], self.encoding)
+		except UnicodeDecodeError:
+			if not self._replaced:
+				self._replaced = True
+				logging.warning("Invalid %s text at line %s in file %s, undecodable bytes replaced",
+					self.encoding, self.line_number(start), self.file_name or "<data>")
+			s = str(self.data[start:end], self.encoding, "replace")
+		return s.replace("\r", "").replace("\n", "")
+
+	def raw_text(self, num):
+		"""
+			Get the text of message num as a memoryview slice of the data
+		"""
+		i = self.index[num] * 5
+		return self.data[self.offsets[i + 3]:self.offsets[i + 4]]
+
+	def text(self, num, default=None):
+		"""
+			Get the decoded text of message num with the line breaks removed
+		"""
+		i = self.index.get(num)
+		if i is None:
+			return default
+		i *= 5
+		return self._decode(self.offsets[i + 3], self.offsets[i + 4])
+
+	def sound(self, num, default=None):
+		i = self.index.get(num)
+		if i is None:
+			return default
+		i *= 5
+		return self._decode(self.offsets[i + 1], self.offsets[i + 2])
+
+	def entries(self):
+		"""
+			Generate (number, sound, text) tuples of all messages in file order
+		"""
+		offsets = self.offsets
+		for i, num in enumerate(self.numbers):
+			j = i * 5
+			yield num, self._decode(offsets[j + 1], offsets[j + 2]), self._decode(offsets[j + 3], offsets[j + 4])
+
 def msg_reader(data, line_index=None, file_name=None):
-	last_msg = None
+	last_msg = None # list of the lines of the current message
 	last_msg_index = 0
+	endcnt = 0
 	if line_index is None:
 		line_index = 0
 
 	def warn():
-		if filename:
+		if file_name:
 			logging.warning("Invalid MSG data at line %s in file %s", line_index + 1, file_name)
 		else:
 			logging.warning("Invalid MSG data at line %s", line_index + 1)
@@ -26,7 +185,7 @@ def msg_reader(data, line_index=None, file_name=None):
 	line_index -= 1
 	while True:
 		line_index += 1
-		l = next(data)
+		l = next(data, "")
 		if not l:
 			if last_msg:
 				warn()
@@ -36,7 +195,8 @@ def msg_reader(data, line_index=None, file_name=None):
 			if len(l) == 0:
 				continue
 			if msg_re.match(l):
-				last_msg = l
+				last_msg = [l]
+				endcnt = 0
 			else:
 				l = l.strip()
 				if len(l) == 0:
@@ -48,15 +208,14 @@ def msg_reader(data, line_index=None, file_name=None):
 				warn()
 				continue
 		else:
-			last_msg = last_msg + l
+			last_msg.append(l)
 
-		endcnt = last_msg.count("}")
+		endcnt += l.count("}")
 		if endcnt > 3:
 			warn()
 			last_msg = None
 		if endcnt == 3:
-			last_msg = last_msg.replace('\n','')
-			match = msg_secs_re.match(last_msg)
+			match = msg_secs_re.match("".join(last_msg).replace('\n',''))
 			if not match:
 				warn()
 				last_msg = None
@@ -0,0 +1,113 @@
+"""
+
+	Fallout palette (color.pal) loading
+
+	A palette file starts with 256 RGB triplets with 6-bit color components
+	(0-63), followed by color conversion tables which are ignored here.
+	Entries with components above 63 are unused and loaded as black. Index 0
+	is transparent.
+
+	Some palette indices are animated by the game: their color cycles through
+	a fixed list of colors, changing every few milliseconds. Palette.at_time
+	gives the palette at a point of time of the animation.
+
+"""
+
+PALETTE_SIZE = 256
+TRANSPARENT_INDEX = 0
+
+# Animated palette ranges: (first index, number of indices, colors, milliseconds per step)
+ANIMATED_RANGES = [
+	# Slime
+	(229, 4, [(0, 108, 0), (11, 115, 7), (27, 123, 15), (43, 131, 27)], 200),
+	# Computer screens
+	(233, 5, [(107, 107, 111), (99, 103, 127), (87, 107, 143), (0, 147, 163), (107, 187, 255)], 100),
+	# Slow fire
+	(238, 5, [(255, 0, 0), (215, 0, 0), (147, 43, 11), (255, 119, 0), (255, 59, 0)], 200),
+	# Fast fire
+	(243, 5, [(71, 0, 0), (123, 0, 0), (179, 0, 0), (123, 0, 0), (71, 0, 0)], 142),
+	# Shoreline
+	(248, 6, [(83, 63, 43), (75, 59, 43), (67, 55, 39), (63, 51, 39), (55, 47, 35), (51, 43, 35)], 200),
+	# Alarm, a single index pulsing red
+	(254, 1, [(x * 4, 0, 0) for x in list(range(0, 16)) + list(range(15, 0, -1))], 33),
+]
+
+class Palette:
+	def __init__(self, colors):
+		"""
+			Palette of 256 (r, g, b) colors with 8-bit components
+		"""
+		if len(colors) != PALETTE_SIZE:
+			raise RuntimeError("Palette must have {} colors".format(PALETTE_SIZE))
+		self.colors = [tuple(x) for x in colors]
+		self._rgba_table = None
+
+	@classmethod
+	def from_bytes(cls, data):
+		"""
+			Parse palette from the contents of a color.pal file
+		"""
+		if len(data) < PALETTE_SIZE * 3:
+			raise RuntimeError("Invalid palette file")
+		colors = []
+		for i in range(0, PALETTE_SIZE * 3, 3):
+			r, g, b = data[i], data[i + 1], data[i + 2]
+			if r > 63 or g > 63 or b > 63:
+				colors.append((0, 0, 0))
+			else:
+				colors.append((r * 4, g * 4, b * 4))
+		return cls(colors)
+
+	@classmethod
+	def load(cls, path):
+		with open(path, "rb") as f:
+			return cls.from_bytes(f.read())
+
+	@classmethod
+	def grayscale(cls):
+		"""
+			Grayscale palette for viewing frames without a color.pal
+		"""
+		return cls([(x, x, x) for x in range(PALETTE_SIZE)])
+
+	def at_time(self, milliseconds):
+		"""
+			Get the palette with the animated colors at the given time
+		"""
+		colors = list(self.colors)
+		for first, count, cycle, step_ms in ANIMATED_RANGES:
+			step = int(milliseconds // step_ms)
+			for i in range(count):
+				colors[first + i] = cycle[(i + step) % len(cycle)]
+		return Palette(colors)
+
+	def rgba_table(self):
+		"""
+			Get the palette as 1024 bytes of RGBA colors, index 0 being fully
+			transparent
+		"""
+		if self._rgba_table is None:
+			table = bytearray()
+			for i, (r, g, b) in enumerate(self.colors):
+				table += bytes((r, g, b, 0 if i == TRANSPARENT_INDEX else 255))
+			self._rgba_table = bytes(table)
+		return self._rgba_table
+
+	def rgba_bytes(self, pixels):
+		"""
+			Convert a buffer of palette indices into RGBA bytes without numpy,
+			translating each color channel with bytes.translate
+		"""
+		table = self.rgba_table()
+		pixels = bytes(pixels)
+		out = bytearray(len(pixels) * 4)
+		for c in range(4):
+			out[c::4] = pixels.translate(table[c::4])
+		return out
+
+	def as_numpy(self):
+		"""
+			Get the palette as a (256, 4) numpy array of RGBA colors
+		"""
+		import numpy as np
+		return np.frombuffer(self.rgba_table(), dtype=np.uint8).reshape(PALETTE_SIZE, 4)
@@ -0,0 +1,55 @@
+import zlib
+import struct
+
+"""
+
+	Minimal PNG writer for 8-bit palette images and RGBA images
+
+"""
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def _chunk(tag, data):
+	return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+def _encode(width, height, data, color_type, bytes_per_pixel, extra_chunks=(), level=6):
+	stride = width * bytes_per_pixel
+	if len(data) != stride * height:
+		raise RuntimeError("Invalid image data size")
+	data = memoryview(data)
+	# Filter type 0 (none) for every row
+	raw = b"".join(b"\0" + data[y*stride:(y+1)*stride] for y in range(height))
+	ihdr = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+	chunks = [_chunk(b"IHDR", ihdr)]
+	chunks.extend(extra_chunks)
+	chunks.append(_chunk(b"IDAT", zlib.compress(raw, level)))
+	chunks.append(_chunk(b"IEND", b""))
+	return _PNG_SIGNATURE + b"".join(chunks)
+
+def encode_indexed(width, height, data, palette=None, transparent_index=0):
+	"""
+		Encode 8-bit palette indices as PNG. palette is a
+		fonlinepy.palette.Palette, or None to write a grayscale image. The
+		color at transparent_index is made transparent unless it is None.
+	"""
+	if palette is None:
+		return _encode(width, height, data, 0, 1)
+	plte = b"".join(bytes(x) for x in palette.colors)
+	extra = [_chunk(b"PLTE", plte)]
+	if transparent_index is not None:
+		extra.append(_chunk(b"tRNS", b"\xff" * transparent_index + b"\0"))
+	return _encode(width, height, data, 3, 1, extra)
+
+def encode_rgba(width, height, data):
+	"""
+		Encode RGBA pixel data as PNG
+	"""
+	return _encode(width, height, data, 6, 4)
+
+def write_indexed(path, width, height, data, palette=None, transparent_index=0):
+	with open(path, "wb") as f:
+		f.write(encode_indexed(width, height, data, palette, transparent_index))
+
+def write_rgba(path, width, height, data):
+	with open(path, "wb") as f:
+		f.write(encode_rgba(width, height, data))
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import threading
+
+"""
+
+	Timing instrumentation
+
+	Code is instrumented with spans, timed blocks named after the step they
+	cover and usually detailed with the file they work on:
+
+		with profiling.span("read_file", path):
+			...
+
+	and counters incremented with profiling.count. Profiling is disabled by
+	default, in which case span returns a shared do-nothing context manager
+	and count returns at once, so the instrumentation costs a function call
+	per file.
+
+	Once enabled, the recorded spans can be printed as a summary per step and
+	per file, or written as a Chrome trace (chrome://tracing, Perfetto).
+
+"""
+
+_enabled = False
+_events = [] # (name, detail, start, duration, process id, thread id), times in seconds
+_counters = {} # counter name -> value
+_lock = threading.Lock()
+
+class _NullSpan:
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		return False
+
+_null_span = _NullSpan()
+
+class _Span:
+	__slots__ = ("name", "detail", "start")
+
+	def __init__(self, name, detail):
+		self.name = name
+		self.detail = detail
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *args):
+		end = time.perf_counter()
+		_events.append((self.name, self.detail, self.start, end - self.start,
+			os.getpid(), threading.get_ident()))
+		return False
+
+def enable():
+	global _enabled
+	_enabled = True
+
+def disable():
+	global _enabled
+	_enabled = False
+
+def is_enabled():
+	return _enabled
+
+def reset():
+	"""
+		Drop the recorded spans and counters
+	"""
+	del _events[:]
+	_counters.clear()
+
+def span(name, detail=None):
+	"""
+		Get context manager timing a block as step 'name'. detail, such as
+		a file name, separates the timings of the step per file.
+	"""
+	if not _enabled:
+		return _null_span
+	return _Span(name, detail)
+
+def count(name, amount=1):
+	if not _enabled:
+		return
+	with _lock:
+		_counters[name] = _counters.get(name, 0) + amount
+
+def collect():
+	"""
+		Get the recorded spans and counters, to be passed to merge() in
+		another process
+	"""
+	return list(_events), dict(_counters)
+
+def merge(collected):
+	"""
+		Add spans and counters returned by collect() in a worker process
+	"""
+	events, counters = collected
+	_events.extend(events)
+	with _lock:
+		for name, value in counters.items():
+			_counters[name] = _counters.get(name, 0) + value
+
+def summary():
+	"""
+		Get list of (name, detail, calls, total seconds, longest seconds) of
+		the recorded spans, by step and by step and detail, longest total
+		first. The rows of whole steps have None as detail.
+	"""
+	rows = {}
+	for name, detail, start, duration, pid, tid in _events:
+		keys = [(name, None)]
+		if detail is not None:
+			keys.append((name, detail))
+		for key in keys:
+			row = rows.get(key)
+			if row is None:
+				rows[key] = [1, duration, duration]
+			else:
+				row[0] += 1
+				row[1] += duration
+				row[2] = max(row[2], duration)
+	return sorted(((name, detail, calls, total, longest) for (name, detail), (calls, total, longest) in rows.items()),
+		key=lambda x: -x[3])
+
+def print_summary(file=None, details=10):
+	"""
+		Print the time of each step, followed by its 'details' slowest files,
+		and the counters
+	"""
+	file = file or sys.stderr
+	rows = summary()
+	print("{:<40} {:>8} {:>10} {:>10}".format("step", "calls", "total s", "max s"), file=file)
+	for name, detail, calls, total, longest in rows:
+		if detail is not None:
+			continue
+		print("{:<40} {:>8} {:>10.4f} {:>10.4f}".format(name, calls, total, longest), file=file)
+		shown = [x for x in rows if x[0] == name and x[1] is not None][:details]
+		for _, detail, calls, total, longest in shown:
+			print("  {:<38} {:>8} {:>10.4f} {:>10.4f}".format(str(detail)[-38:], calls, total, longest), file=file)
+	for name, value in sorted(_counters.items()):
+		print("{:<40} {:>8}".format(name, value), file=file)
+
+def write_trace(path):
+	"""
+		Write the recorded spans and counters into a Chrome trace JSON file
+	"""
+	events = []
+	for name, detail, start, duration, pid, tid in _events:
+		event = {
+			"name": name,
+			"cat": "fonlinepy",
+			"ph": "X",
+			"ts": start * 1e6,
+			"dur": duration * 1e6,
+			"pid": pid,
+			"tid": tid
+		}
+		if detail is not None:
+			event["args"] = {"detail": str(detail)}
+		events.append(event)
+	with open(path, "wt") as f:
+		json.dump({"traceEvents": events, "otherData": {"counters": _counters}}, f)
+
+def report(target):
+	"""
+		Print the summary if target is "-", otherwise write the trace into
+		file target. Used by the --profile option of the tools.
+	"""
+	if target == "-":
+		print_summary()
+	else:
+		write_trace(target)
@@ -0,0 +1,104 @@
+import os
+import hashlib
+import logging
+import marshal
+import tempfile
+import fonlinepy.protoparser as protoparser
+import fonlinepy.protofile as protofile
+from collections import OrderedDict
+
+"""
+
+	On-disk cache of parsed fopro file sections
+
+	Each cached file is stored in its own entry in the cache directory. An
+	entry is a marshal dump of the path, modification time and size of the
+	fopro file followed by the parsed sections and the line ranges of the
+	sections that failed to parse. Entries whose file has been
+	modified since are ignored and overwritten on the next store.
+
+"""
+
+CACHE_VERSION = 1
+
+class ProtoCache:
+	def __init__(self, cache_path):
+		self.cache_path = cache_path # Directory containing the cache entries
+
+	def _entry_path(self, path):
+		key = hashlib.sha1(os.path.abspath(path).encode("utf-8", "surrogateescape")).hexdigest()
+		return os.path.join(self.cache_path, key + ".fpc")
+
+	@staticmethod
+	def file_key(path):
+		"""
+			Get the key identifying the current contents of file path. Raises
+			OSError if the file can't be accessed.
+		"""
+		st = os.stat(path)
+		return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+	def load_sections(self, proto_file):
+		"""
+			Restore the sections of proto_file from the cache. Returns False if
+			the file has no valid cache entry.
+		"""
+		try:
+			key = self.file_key(proto_file.path)
+			with open(self._entry_path(proto_file.path), "rb") as f:
+				entry = marshal.loads(f.read())
+		except OSError:
+			return False
+		except (EOFError, ValueError, TypeError):
+			logging.warning("Ignoring corrupted cache entry for %s", proto_file.path)
+			return False
+
+		if not isinstance(entry, tuple) or len(entry) != 6:
+			return False
+		version, path, mtime, size, sections, invalid_ranges = entry
+		if version != CACHE_VERSION or (path, mtime, size) != key:
+			return False
+
+		proto_file.sections = OrderedDict()
+		for pid, start, end, keys, values, overrides in sections:
+			proto = protoparser.CachedProto(pid, OrderedDict(zip(keys, values)), overrides)
+			proto_file.sections[pid] = protofile.ProtoFileSection((start, end), None, proto)
+		proto_file.invalid_ranges = [tuple(r) for r in invalid_ranges]
+		proto_file.read_stamp = (mtime, size)
+		for start, end in proto_file.invalid_ranges:
+			logging.warning("Illegal proto file %s: invalid proto definition at lines %s - %s",
+				proto_file.path, start+1, end+1)
+		logging.info("Loaded %s protos from cache for %s", len(proto_file.sections), proto_file.path)
+		return True
+
+	def store_sections(self, proto_file, key=None):
+		"""
+			Store the sections of proto_file into the cache. key is the
+			file_key of the file taken before it was read, so that changes
+			made while parsing invalidate the entry. Without it the file is
+			checked now.
+		"""
+		if key is None:
+			try:
+				key = self.file_key(proto_file.path)
+			except OSError:
+				return
+		sections = tuple(
+			(pid, s.line_range[0], s.line_range[1],
+				tuple(s.proto.data.keys()), tuple(s.proto.data.values()), tuple(s.proto.overrides))
+			for pid, s in proto_file.sections.items())
+		invalid_ranges = tuple(tuple(r) for r in proto_file.invalid_ranges)
+		data = marshal.dumps((CACHE_VERSION,) + key + (sections, invalid_ranges))
+
+		try:
+			os.makedirs(self.cache_path, exist_ok=True)
+			fd, tmp_path = tempfile.mkstemp(dir=self.cache_path, suffix=".tmp")
+			try:
+				with os.fdopen(fd, "wb") as f:
+					f.write(data)
+				os.replace(tmp_path, self._entry_path(proto_file.path))
+			except BaseException:
+				os.unlink(tmp_path)
+				raise
+		except OSError as e:
+			logging.warning("Failed to write cache entry for %s: %s", proto_file.path, e)
@@ -0,0 +1,119 @@
+import fonlinepy.protoquery as protoquery
+from collections import OrderedDict
+
+"""
+
+	Columnar export of proto data
+
+	Turns the protos of read fopro files into a table with one column per
+	field. Columns whose values all parse as integers are stored as int64,
+	other columns as strings. Each column has a presence mask telling which
+	protos define the field.
+
+	Writing .npz files requires numpy, writing Parquet files requires pyarrow.
+
+"""
+
+_INT64_MIN = -2**63
+_INT64_MAX = 2**63 - 1
+
+class Column:
+	def __init__(self, name, values, present, is_int):
+		self.name = name # field name
+		self.values = values # value of each row, 0 or "" if not present
+		self.present = present # whether each row has the field
+		self.is_int = is_int # whether the values are integers
+
+def build_columns(proto_files):
+	"""
+		Build the columns of the protos in the read ProtoFiles proto_files.
+		Returns an OrderedDict of Columns by name, starting with the
+		'ProtoId' and 'ProtoFile' (file name) columns.
+	"""
+	pids = []
+	files = []
+	fields = OrderedDict() # field name -> {row -> value}
+	for x in proto_files:
+		for pid, section in x.sections.items():
+			row = len(pids)
+			pids.append(pid)
+			files.append(x.name)
+			for k, v in section.proto.data.items():
+				fields.setdefault(k, {})[row] = v
+
+	n = len(pids)
+	columns = OrderedDict()
+	columns["ProtoId"] = Column("ProtoId", pids, [True] * n, True)
+	columns["ProtoFile"] = Column("ProtoFile", files, [True] * n, False)
+	for name, rows in fields.items():
+		present = [False] * n
+		for row in rows:
+			present[row] = True
+		ints = {}
+		for row, v in rows.items():
+			iv = protoquery.parse_int(v)
+			if iv is None or iv < _INT64_MIN or iv > _INT64_MAX:
+				ints = None
+				break
+			ints[row] = iv
+		if ints is not None:
+			values = [0] * n
+			for row, iv in ints.items():
+				values[row] = iv
+		else:
+			values = [""] * n
+			for row, v in rows.items():
+				values[row] = str(v)
+		columns[name] = Column(name, values, present, ints is not None)
+	return columns
+
+def to_numpy(proto_files):
+	"""
+		Get the columns as numpy arrays. Returns an OrderedDict with an array
+		for each column and a boolean array named '<column>.mask' for each
+		field column.
+	"""
+	import numpy as np
+	arrays = OrderedDict()
+	for name, col in build_columns(proto_files).items():
+		if col.is_int:
+			arrays[name] = np.array(col.values, dtype=np.int64)
+		else:
+			arrays[name] = np.array(col.values, dtype=np.str_)
+		if name not in ("ProtoId", "ProtoFile"):
+			arrays[name + ".mask"] = np.array(col.present, dtype=np.bool_)
+	return arrays
+
+def write_npz(path, proto_files, compressed=True):
+	import numpy as np
+	arrays = to_numpy(proto_files)
+	if compressed:
+		np.savez_compressed(path, **arrays)
+	else:
+		np.savez(path, **arrays)
+
+def write_parquet(path, proto_files):
+	"""
+		Write the columns into a Parquet file. Missing fields are stored as
+		nulls instead of using separate masks.
+	"""
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+	arrays = []
+	names = []
+	for name, col in build_columns(proto_files).items():
+		values = [v if p else None for v, p in zip(col.values, col.present)]
+		arrays.append(pa.array(values, type=pa.int64() if col.is_int else pa.string()))
+		names.append(name)
+	pq.write_table(pa.Table.from_arrays(arrays, names=names), path)
+
+def export(path, proto_files):
+	"""
+		Export into path, using the format matching its extension
+	"""
+	if path.lower().endswith(".parquet"):
+		write_parquet(path, proto_files)
+	elif path.lower().endswith(".npz"):
+		write_npz(path, proto_files)
+	else:
+		raise RuntimeError("Unknown export format for {}, use .npz or .parquet".format(path))
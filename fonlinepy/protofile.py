@@ -1,8 +1,11 @@
 import os
 import re
 import logging
+import concurrent.futures
 import fonlinepy.protoparser as protoparser
+import fonlinepy.profiling as profiling
 from collections import OrderedDict
+from contextlib import contextmanager
 
 """
 
@@ -13,9 +16,24 @@ from collections import OrderedDict
 PROTO_PATH = "proto/items"
 
 class ProtoFileSection:
-	def __init__(self, line_range, lines):
-		self.line_range = line_range
-		self.proto = protoparser.ParsedProto(lines[1:])
+	def __init__(self, line_range, lines, proto=None):
+		self._range = line_range
+		self._file = None # ProtoFile holding the lines of the section in its chunks
+		self._chunk = None # index of the chunk of the section
+		if proto is None:
+			proto = protoparser.ParsedProto(lines[1:])
+		self.proto = proto
+
+	@property
+	def line_range(self):
+		if self._file is not None:
+			return self._file._chunk_range(self._chunk)
+		return self._range
+
+	@line_range.setter
+	def line_range(self, line_range):
+		self._file = None
+		self._range = line_range
 
 class ProtoFile:
 	def __init__(self, name, path, active=None, last_modification=None):
@@ -23,12 +41,138 @@ class ProtoFile:
 		self.path = path # File path
 		self.active = active # whether the fopro is listed in items.lst
 		self.last_modification = last_modification # last modification timestamp
-		self.lines = [] # list of all lines in the fopro file
+		self._lines = [] # list of all lines, None if only self._chunks is up to date
+		self._chunks = None # lines split into chunks, one per section, once edited
+		self._chunk_starts = None # first line of each chunk, None if not computed
 		self.sections = OrderedDict() # dictionary of proto sections in the file, with PID as key
+		self.invalid_ranges = [] # line ranges of the proto sections that failed to parse, as read
+		self.lines_pending = False # whether sections were read without reading self.lines
+		self.read_stamp = None # (mtime, size) of the file when the sections or lines were read, None if unknown
+
+	@property
+	def lines(self):
+		"""
+			List of all lines in the fopro file
+		"""
+		if self._lines is None:
+			self._lines = [l for chunk in self._chunks for l in chunk]
+		return self._lines
+
+	@lines.setter
+	def lines(self, lines):
+		if self._chunks is not None:
+			for section in self.sections.values():
+				if section._file is self:
+					section.line_range = section.line_range
+			self._chunks = None
+			self._chunk_starts = None
+		self._lines = lines
+
+	def _split_chunks(self):
+		"""
+			Split the lines into chunks at the boundaries of the sections, so
+			that a section can be replaced without moving the other lines. The
+			line ranges of the sections are computed from the chunks from now
+			on.
+		"""
+		lines = self.lines
+		bounds = set((0, len(lines)))
+		for section in self.sections.values():
+			bounds.update(section.line_range)
+		for r in self.invalid_ranges:
+			bounds.update(r)
+		bounds = sorted(x for x in bounds if 0 <= x <= len(lines))
+		chunk_index = {}
+		chunks = []
+		for start, end in zip(bounds, bounds[1:]):
+			chunk_index[start] = len(chunks)
+			chunks.append(lines[start:end])
+		self._chunks = chunks
+		self._chunk_starts = bounds[:-1]
+		for section in self.sections.values():
+			section._chunk = chunk_index[section.line_range[0]]
+			section._file = self
+
+	def _chunk_range(self, i):
+		if self._chunk_starts is None:
+			starts = []
+			line = 0
+			for chunk in self._chunks:
+				starts.append(line)
+				line += len(chunk)
+			self._chunk_starts = starts
+		start = self._chunk_starts[i]
+		return (start, start + len(self._chunks[i]))
 
 	def read_file(self):
-		with open(self.path) as f:
-			self.lines = [l.rstrip("\n") for l in f]
+		with profiling.span("read_file", self.name):
+			with open(self.path) as f:
+				st = os.fstat(f.fileno())
+				self.read_stamp = (st.st_mtime_ns, st.st_size)
+				self.lines = [l.rstrip("\n") for l in f]
+		self.lines_pending = False
+
+	def read_pending_lines(self):
+		"""
+			Read the lines of the file if the sections were read without them,
+			so that the line ranges of the sections can be used for rewrites.
+			Raises RuntimeError if the file has been modified since the
+			sections were read, as their line ranges no longer apply.
+		"""
+		if self.lines_pending:
+			stamp = self.read_stamp
+			self.read_file()
+			if stamp is not None and self.read_stamp != stamp:
+				self.lines = []
+				self.lines_pending = True
+				self.read_stamp = stamp
+				raise RuntimeError("Proto file {} was modified after its sections were read".format(self.path))
+
+	def load(self, cache=None, read_lines=True):
+		"""
+			Read the file and its proto sections. If a ProtoCache is given,
+			the sections are restored from it when the file hasn't changed,
+			and stored to it after parsing otherwise.
+			
+			If read_lines is False, self.lines is left empty: the sections are
+			either found in the cache or read with read_sections_streaming.
+			Sections of a previous load are dropped.
+		"""
+		self.sections = OrderedDict()
+		self.invalid_ranges = []
+		self.read_stamp = None
+		cached = False
+		if cache is not None:
+			with profiling.span("cache_load", self.name):
+				cached = cache.load_sections(self)
+		if cached:
+			if not read_lines:
+				self.lines_pending = True
+				return
+			stamp = self.read_stamp
+			self.read_file()
+			if self.read_stamp == stamp:
+				return
+			# Modified after the cache entry was checked, parse it instead
+			self.sections = OrderedDict()
+			self.invalid_ranges = []
+		key = None
+		if cache is not None:
+			try:
+				key = cache.file_key(self.path)
+			except OSError:
+				pass
+		if read_lines:
+			self.read_file()
+			with profiling.span("parse_sections", self.name):
+				self.read_sections()
+		else:
+			with profiling.span("parse_sections_streaming", self.name):
+				self.read_sections_streaming()
+		profiling.count("protos_parsed", len(self.sections))
+		if key is not None:
+			with profiling.span("cache_store", self.name):
+				cache.store_sections(self, key)
 
 	def read_sections(self):
 		active_section = False
@@ -42,6 +186,7 @@ class ProtoFile:
 					pfs = ProtoFileSection((last_proto_start, line_index), self.lines[last_proto_start:line_index])
 					self.sections[pfs.proto.id] = pfs
 				except RuntimeError as a:
+					self.invalid_ranges.append((last_proto_start, line_index))
 					logging.warning("Illegal proto file %s: invalid proto definition at lines %s - %s",
 						self.path, last_proto_start+1, line_index+1, exc_info=a)
 			active_section = True
@@ -65,31 +210,137 @@ class ProtoFile:
 		next_proto(len(self.lines))
 		logging.info("Loaded %s protos from %s", len(self.sections), self.path)
 
-	def shift_ranges(self, amount, starting_from = 0):
-		for e in self.sections.values():
-			if e.line_range[0] > starting_from:
-				e.line_range = [e.line_range[0] + amount, e.line_range[1] + amount]
+	def read_sections_streaming(self, f=None):
+		"""
+			Read proto sections in a single pass over the file without storing
+			its lines, parsing each line as it is read. Only the line ranges of
+			the sections are kept, self.lines is read later by
+			read_pending_lines when needed.
+			
+			f can be any iterable of lines, such as an open text file or a
+			io.TextIOWrapper over a memory-mapped buffer, in which case
+			self.read_stamp should be set by the caller. By default the file
+			at self.path is opened.
+		"""
+		if f is None:
+			with open(self.path) as f:
+				st = os.fstat(f.fileno())
+				self.read_stamp = (st.st_mtime_ns, st.st_size)
+				return self.read_sections_streaming(f)
+		
+		proto = None
+		error = None
+		last_proto_start = 0
+		def next_proto(line_index):
+			if proto is None:
+				return
+			try:
+				if error is not None:
+					raise error
+				proto.finish_parse()
+				self.sections[proto.id] = ProtoFileSection((last_proto_start, line_index), None, proto)
+			except RuntimeError as a:
+				self.invalid_ranges.append((last_proto_start, line_index))
+				logging.warning("Illegal proto file %s: invalid proto definition at lines %s - %s",
+					self.path, last_proto_start+1, line_index+1, exc_info=a)
+
+		line_count = 0
+		for i, l in enumerate(f):
+			line_count = i + 1
+			dl = l.strip()
+			
+			if len(dl) == 0:
+				continue
+			
+			if dl == "[Proto]":
+				next_proto(i)
+				proto = protoparser.StreamedProto()
+				error = None
+				last_proto_start = i
 				continue
 
-	def replace_range(self, proto_fields, r_range):
-		outd = ["[Proto]"] + list(proto_fields) + [""]
-		new_range = (r_range[0], r_range[0] + len(outd))
-		len_diff = new_range[1] - r_range[1]
-		self.lines[r_range[0]:r_range[1]] = outd
-		self.shift_ranges(len_diff, r_range[0])
-		return new_range
+			if proto is None:
+				if dl[0] == "#":
+					continue
+				logging.warning("Illegal proto file %s: Garbage in header", self.path)
+				continue
+			
+			if error is None:
+				try:
+					proto.parse_line(dl)
+				except RuntimeError as a:
+					error = a
+		next_proto(line_count)
+		self.lines_pending = True
+		logging.info("Loaded %s protos from %s", len(self.sections), self.path)
+
+	def compact(self, schema=None, keep_lines=False):
+		"""
+			Convert the protos of the file into CompactProtos sharing the
+			ProtoSchema schema, or a new schema if not given. Unless keep_lines
+			is set, the lines of the file are dropped as well and read again
+			by read_pending_lines when needed. Returns the schema.
+		"""
+		if schema is None:
+			schema = protoparser.ProtoSchema()
+		for section in self.sections.values():
+			if not isinstance(section.proto, protoparser.CompactProto):
+				section.proto = protoparser.CompactProto.from_proto(section.proto, schema)
+		if not keep_lines and not self.lines_pending:
+			self.lines = []
+			self.lines_pending = True
+		return schema
 
 	def update_proto(self, proto_id, proto_dict):
-		gp = protoparser.GeneratedProto(proto_id, proto_dict)
-		if proto_id in self.sections:
-			section = self.sections[proto_id]
-			section.proto = gp
-			new_range = self.replace_range(gp.as_lines(), section.line_range)
-			section.line_range = new_range
-		else:
-			new_range = self.replace_range(gp.as_lines(), (len(self.lines), len(self.lines)))
-			pfs = ProtoFileSection(new_range, self.lines[new_range[0]:new_range[1]])
-			self.sections[proto_id] = pfs
+		"""
+			Replace the section of proto_id with a proto generated from
+			proto_dict, or append it to the end of the file. Only the lines of
+			the section are rebuilt; the line ranges of the sections are
+			computed again when next needed.
+		"""
+		self.update_protos({proto_id: proto_dict})
+
+	def update_protos(self, protos):
+		"""
+			Update the protos of dictionary protos (proto id -> proto
+			dictionary) as in update_proto, in one pass. All the lines are
+			generated before any change is made, so the file is left
+			unchanged if any of the protos fails.
+		"""
+		self.read_pending_lines()
+		generated = []
+		for proto_id, proto_dict in protos.items():
+			gp = protoparser.GeneratedProto(proto_id, proto_dict)
+			generated.append((gp, ["[Proto]"] + list(gp.as_lines()) + [""]))
+		if len(generated) == 0:
+			return
+		
+		if self._chunks is None:
+			self._split_chunks()
+		for gp, outd in generated:
+			section = self.sections.get(gp.id)
+			if section is not None and section._file is self:
+				section.proto = gp
+				self._chunks[section._chunk] = outd
+			else:
+				section = ProtoFileSection(None, None, gp)
+				section._chunk = len(self._chunks)
+				section._file = self
+				self._chunks.append(outd)
+				self.sections[gp.id] = section
+		self._lines = None
+		self._chunk_starts = None
+
+	@contextmanager
+	def batch(self):
+		"""
+			Context collecting proto updates into a dictionary (proto id ->
+			proto dictionary), applied with update_protos when the context
+			exits. Nothing is applied if the context exits with an exception.
+		"""
+		updates = OrderedDict()
+		yield updates
+		self.update_protos(updates)
 
 """
 	Load files from directory target_path
@@ -116,19 +367,20 @@ def load_freestanding_proto_files(target_path):
 
 	found_active_protos = 0
 	fopro_regex = re.compile(r'.+\.fopro$')
-	try:
-		with os.scandir(target_path) as scandir:
-			for x in scandir:
-				if not fopro_regex.match(x.name):
-					continue
+	with profiling.span("scan_directory", target_path):
+		try:
+			with os.scandir(target_path) as scandir:
+				for x in scandir:
+					if not fopro_regex.match(x.name):
+						continue
 
-				active = x.name in active_protos
-				st = x.stat()
-				proto_files.append(ProtoFile(x.name, x.path, active, st.st_mtime))
-				if active:
-					found_active_protos += 1
-	except OSError as e:
-		logging.warning("Failed to read directory '%s'", target_path)
+					active = x.name in active_protos
+					st = x.stat()
+					proto_files.append(ProtoFile(x.name, x.path, active, st.st_mtime))
+					if active:
+						found_active_protos += 1
+		except OSError as e:
+			logging.warning("Failed to read directory '%s'", target_path)
 	
 	logging.info("Read %s out of %s active proto files",found_active_protos, len(active_protos))
 	if found_active_protos != len(active_protos):
@@ -137,6 +389,102 @@ def load_freestanding_proto_files(target_path):
 
 	return proto_files
 
+def _read_proto_file(proto_file, cache=None, read_lines=True):
+	proto_file.load(cache, read_lines)
+	return proto_file
+
+class _LogCollector(logging.Handler):
+	"""
+		Collects log records in a worker process so that they can be sent back
+		and handled by the loggers of the main process.
+	"""
+	def __init__(self):
+		super().__init__()
+		self.records = []
+
+	def emit(self, record):
+		# Tracebacks and arguments can't be pickled: format them into the message
+		record.msg = self.format(record)
+		record.args = None
+		record.exc_info = None
+		record.exc_text = None
+		self.records.append(record)
+
+def _read_proto_file_in_worker(proto_file, cache, read_lines, log_level, profile):
+	root = logging.getLogger()
+	old_handlers, old_level = root.handlers, root.level
+	collector = _LogCollector()
+	root.handlers = [collector]
+	root.setLevel(log_level)
+	if profile:
+		profiling.reset()
+		profiling.enable()
+	try:
+		_read_proto_file(proto_file, cache, read_lines)
+	finally:
+		root.handlers = old_handlers
+		root.setLevel(old_level)
+	return proto_file, collector.records, profiling.collect() if profile else None
+
+"""
+	Read and parse proto_files using a pool of workers.
+	
+	The files are distributed across 'workers' worker processes (or threads if
+	use_threads is set, default is the number of CPUs). Returns a list of the
+	read ProtoFile objects in the same order as proto_files. When processes are
+	used the returned objects are copies of the ones given as input.
+	
+	Errors are reported in the same way as when reading the files one by one:
+	invalid proto definitions are logged as warnings, and exceptions such as
+	OSError are raised in the caller.
+	
+	The cache and read_lines arguments are passed to ProtoFile.load. If a
+	ProtoSchema is given, the protos are converted to CompactProtos sharing
+	it with ProtoFile.compact.
+"""
+def read_proto_files(proto_files, workers=None, use_threads=False, cache=None, read_lines=True, schema=None):
+	result = _read_proto_files(proto_files, workers, use_threads, cache, read_lines)
+	if schema is not None:
+		for x in result:
+			x.compact(schema, read_lines)
+	return result
+
+def _read_proto_files(proto_files, workers, use_threads, cache, read_lines):
+	proto_files = list(proto_files)
+	if workers is None:
+		workers = os.cpu_count() or 1
+	workers = min(workers, len(proto_files))
+	n = len(proto_files)
+	
+	if workers <= 1:
+		return [_read_proto_file(x, cache, read_lines) for x in proto_files]
+	
+	if use_threads:
+		with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+			return list(executor.map(_read_proto_file, proto_files, [cache] * n, [read_lines] * n))
+	
+	log_level = logging.getLogger().getEffectiveLevel()
+	profile = profiling.is_enabled()
+	chunksize = max(1, n // (workers * 4))
+	result = []
+	with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+		for proto_file, records, collected in executor.map(_read_proto_file_in_worker,
+				proto_files, [cache] * n, [read_lines] * n, [log_level] * n, [profile] * n, chunksize=chunksize):
+			for record in records:
+				logging.getLogger(record.name).handle(record)
+			if collected is not None:
+				profiling.merge(collected)
+			result.append(proto_file)
+	return result
+
+"""
+	Load files from directory target_path and read them in parallel using
+	read_proto_files
+"""
+def load_freestanding_proto_files_parallel(target_path, workers=None, use_threads=False, cache=None, read_lines=True, schema=None):
+	proto_files = load_freestanding_proto_files(target_path)
+	return read_proto_files(proto_files, workers, use_threads, cache, read_lines, schema)
+
 """
 	Load files from server server_path
 """
@@ -0,0 +1,150 @@
+import bisect
+from collections import OrderedDict
+
+"""
+
+	Index of proto PIDs across a set of fopro files
+
+	Gives the location of each PID, lists the PIDs defined more than once and
+	answers free PID queries from a list of used PID intervals.
+
+"""
+
+class ProtoLocation:
+	def __init__(self, proto_file, section):
+		self.proto_file = proto_file # ProtoFile containing the proto
+		self.section = section # ProtoFileSection of the proto
+
+	@property
+	def line_range(self):
+		return self.section.line_range
+
+class ProtoIndex:
+	def __init__(self, proto_files=()):
+		"""
+			Build an index of the sections of the read ProtoFiles proto_files
+		"""
+		self.locations = {} # PID -> list of ProtoLocations, first occurence first
+		self.proto_files = OrderedDict() # indexed ProtoFiles by path
+		self._file_pids = {} # path -> PIDs indexed for the file, it may have been read again since
+		self._pids = None # sorted PIDs
+		self._starts = None # first PIDs of the used PID intervals
+		self._ends = None # last PIDs of the used PID intervals
+		for x in proto_files:
+			self.add_file(x)
+
+	def __len__(self):
+		return len(self.locations)
+
+	def __contains__(self, pid):
+		return pid in self.locations
+
+	def add_file(self, proto_file):
+		if proto_file.path in self.proto_files:
+			raise RuntimeError("Proto file {} is already indexed".format(proto_file.path))
+		self.proto_files[proto_file.path] = proto_file
+		self._file_pids[proto_file.path] = list(proto_file.sections)
+		for pid, section in proto_file.sections.items():
+			self.locations.setdefault(pid, []).append(ProtoLocation(proto_file, section))
+		self._pids = self._starts = self._ends = None
+
+	def remove_file(self, proto_file):
+		if self.proto_files.pop(proto_file.path, None) is None:
+			return
+		for pid in self._file_pids.pop(proto_file.path):
+			locs = self.locations.get(pid)
+			if locs is None:
+				continue
+			locs = [x for x in locs if x.proto_file.path != proto_file.path]
+			if len(locs) > 0:
+				self.locations[pid] = locs
+			else:
+				del self.locations[pid]
+		self._pids = self._starts = self._ends = None
+
+	def update_file(self, proto_file):
+		"""
+			Update the index after proto_file has been read again. The old
+			entries of the file are looked up by its path.
+		"""
+		old = self.proto_files.get(proto_file.path)
+		if old is not None:
+			self.remove_file(old)
+		self.add_file(proto_file)
+
+	def lookup(self, pid):
+		"""
+			Get the ProtoLocation of the first occurence of pid, or None
+		"""
+		locs = self.locations.get(pid)
+		return locs[0] if locs else None
+
+	def conflicts(self):
+		"""
+			Get list of (PID, locations) pairs of PIDs defined more than once,
+			sorted by PID
+		"""
+		return [(pid, locs) for pid, locs in sorted(self.locations.items()) if len(locs) > 1]
+
+	def pids(self):
+		"""
+			Get sorted list of the indexed PIDs
+		"""
+		if self._pids is None:
+			self._pids = sorted(self.locations)
+		return self._pids
+
+	def _get_intervals(self):
+		if self._starts is None:
+			starts = []
+			ends = []
+			for pid in self.pids():
+				if len(ends) > 0 and ends[-1] + 1 == pid:
+					ends[-1] = pid
+				else:
+					starts.append(pid)
+					ends.append(pid)
+			self._starts = starts
+			self._ends = ends
+		return self._starts, self._ends
+
+	def used_ranges(self):
+		"""
+			Get list of (first, last) ranges of used PIDs
+		"""
+		starts, ends = self._get_intervals()
+		return list(zip(starts, ends))
+
+	def free_ranges(self, size=1, start=1, count=None):
+		"""
+			Generate (first, last) ranges of at least 'size' consecutive free
+			PIDs, starting from PID 'start'. The last range after all used
+			PIDs is unbounded and has None as its last PID. At most 'count'
+			ranges are generated if given.
+		"""
+		starts, ends = self._get_intervals()
+		i = bisect.bisect_right(ends, start - 1)
+		first = start
+		found = 0
+		while count is None or found < count:
+			if i >= len(starts):
+				yield (first, None)
+				return
+			if starts[i] > first and starts[i] - first >= size:
+				yield (first, starts[i] - 1)
+				found += 1
+			first = max(first, ends[i] + 1)
+			i += 1
+
+	def free_pids(self, count, start=1):
+		"""
+			Get list of the first 'count' free PIDs starting from PID 'start'
+		"""
+		pids = []
+		for first, last in self.free_ranges(1, start):
+			if last is None:
+				last = first + count - len(pids) - 1
+			pids.extend(range(first, min(last, first + count - len(pids) - 1) + 1))
+			if len(pids) >= count:
+				return pids
+		return pids
@@ -0,0 +1,57 @@
+import fonlinepy.msgcorpus as msgcorpus
+
+"""
+
+	Cross-referencing protos with their MSG texts
+
+	The name of an item is message PID*100 of FOOBJ.MSG and its description
+	message PID*100+1. The sorted PIDs of a ProtoIndex and the sorted message
+	numbers of a MSG file are compared in a single merge pass.
+
+"""
+
+NAME_OFFSET = 0
+DESCRIPTION_OFFSET = 1
+
+class ProtoMsgReport:
+	def __init__(self):
+		self.missing_names = [] # PIDs without a name message
+		self.missing_descriptions = [] # PIDs without a description message
+		self.orphans = [] # message numbers of PIDs not found in the protos
+		self.duplicate_pids = [] # (PID, locations) of PIDs defined more than once
+		self.duplicate_messages = [] # message numbers defined more than once
+
+def cross_reference(index, msg):
+	"""
+		Compare the protos of ProtoIndex index with the messages of msg, a
+		MsgFile or a msgcorpus.MsgTable. Returns a ProtoMsgReport.
+	"""
+	report = ProtoMsgReport()
+	report.duplicate_pids = index.conflicts()
+	if isinstance(msg, msgcorpus.MsgTable):
+		table = msg
+	else:
+		table = msgcorpus.MsgTable.from_msg_file(msg)
+		report.duplicate_messages = sorted(set(msg.duplicates))
+
+	numbers = table.numbers
+	j = 0
+	for pid in index.pids():
+		# Messages before the ones of this PID belong to no proto
+		while j < len(numbers) and numbers[j] // 100 < pid:
+			report.orphans.append(numbers[j])
+			j += 1
+		has_name = has_description = False
+		while j < len(numbers) and numbers[j] // 100 == pid:
+			sub = numbers[j] % 100
+			if sub == NAME_OFFSET:
+				has_name = True
+			elif sub == DESCRIPTION_OFFSET:
+				has_description = True
+			j += 1
+		if not has_name:
+			report.missing_names.append(pid)
+		if not has_description:
+			report.missing_descriptions.append(pid)
+	report.orphans.extend(numbers[j:])
+	return report
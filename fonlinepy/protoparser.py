@@ -1,37 +1,55 @@
+import sys
 import logging
 from collections import OrderedDict
+from collections.abc import MutableMapping
 
 class Proto:
+	__slots__ = ()
+	
 	def __init__():
 		self.id = None
 		self.data = OrderedDict()
 		self.overrides = set()
 
 
-	def _parse(self, lines):
-		ls = map(lambda x: x.split("#")[0], lines)
-		ls = map(str.strip, ls)
-		ls = filter(len, ls)
-
-		for x in ls:
-			
-			spl = tuple(map(str.strip, x.split("=")))
-			if len(spl) != 2:
-				raise RuntimeError("Invalid proto syntax")
-			
-			if len(spl[0]) == 0:
+	def parse_line(self, line):
+		"""
+			Parse a single line of the proto definition
+		"""
+		if "#" in line:
+			line = line[:line.index("#")]
+		key, sep, value = line.partition("=")
+		if not sep:
+			if line.strip():
 				raise RuntimeError("Invalid proto syntax")
+			return
+		
+		key = key.strip()
+		value = value.strip()
+		if not key or "=" in value:
+			raise RuntimeError("Invalid proto syntax")
 
-			if spl[0] in self.data:
-				self.overrides.add(spl[0])
+		data = self.data
+		if key in data:
+			self.overrides.add(key)
 
-			self.data[spl[0]] = spl[1]
+		data[key] = value
+
+	def finish_parse(self):
+		"""
+			Finish parsing after all lines have been given to parse_line
+		"""
 		try:
 			self.id = int(self.data["ProtoId"])
 		except:
 			raise RuntimeError("Proto definition does not contain a valid ProtoId")
 		del self.data["ProtoId"]
 
+	def _parse(self, lines):
+		for x in lines:
+			self.parse_line(x)
+		self.finish_parse()
+
 	def as_lines(self):
 		yield "{}={}".format("ProtoId", self.id)
 
@@ -61,3 +79,130 @@ class GeneratedProto(Proto):
 	def __init__(self, proto_id, proto_dict):
 		self.data = proto_dict
 		self.id = proto_id
+
+class StreamedProto(Proto):
+	def __init__(self):
+		"""
+			A proto parsed incrementally, line by line, with parse_line and
+			finish_parse. Does not hold the original lines.
+		"""
+		self.id = None
+		self.data = OrderedDict()
+		self.overrides = set()
+
+class CachedProto(Proto):
+	def __init__(self, proto_id, proto_dict, overrides=()):
+		"""
+			A proto restored from previously parsed data, such as the proto
+			cache. Does not hold the original lines.
+		"""
+		self.id = proto_id
+		self.data = proto_dict
+		self.overrides = set(overrides)
+
+class ProtoSchema:
+	def __init__(self):
+		"""
+			Shared table of key layouts for CompactProtos. Protos compacted with
+			the same schema share interned key tuples instead of each holding
+			its own dictionary.
+		"""
+		self.layouts = {} # key tuple -> ProtoLayout
+
+	def layout(self, keys):
+		keys = tuple(keys)
+		layout = self.layouts.get(keys)
+		if layout is None:
+			keys = tuple(map(sys.intern, keys))
+			layout = ProtoLayout(self, keys)
+			self.layouts[keys] = layout
+		return layout
+
+class ProtoLayout:
+	__slots__ = ("schema", "keys", "index")
+
+	def __init__(self, schema, keys):
+		self.schema = schema
+		self.keys = keys # field names in order
+		self.index = dict((k, i) for i, k in enumerate(keys)) # field name -> position
+
+	def with_key(self, key):
+		return self.schema.layout(self.keys + (key,))
+
+	def without_key(self, key):
+		i = self.index[key]
+		return self.schema.layout(self.keys[:i] + self.keys[i+1:])
+
+class ProtoData(MutableMapping):
+	"""
+		Mapping view of the fields of a CompactProto, behaving like the
+		OrderedDict 'data' of the other protos.
+	"""
+	__slots__ = ("_proto",)
+
+	def __init__(self, proto):
+		self._proto = proto
+
+	def __getitem__(self, key):
+		p = self._proto
+		return p.values[p.layout.index[key]]
+
+	def __setitem__(self, key, value):
+		p = self._proto
+		i = p.layout.index.get(key)
+		if i is None:
+			p.layout = p.layout.with_key(key)
+			p.values.append(value)
+		else:
+			p.values[i] = value
+
+	def __delitem__(self, key):
+		p = self._proto
+		i = p.layout.index[key]
+		p.layout = p.layout.without_key(key)
+		del p.values[i]
+
+	def __contains__(self, key):
+		return key in self._proto.layout.index
+
+	def __iter__(self):
+		return iter(self._proto.layout.keys)
+
+	def __len__(self):
+		return len(self._proto.values)
+
+	def __repr__(self):
+		return "ProtoData({})".format(dict(self))
+
+_NO_OVERRIDES = frozenset()
+
+def _intern(value):
+	# Values such as "0", "1" and art paths repeat across protos
+	return sys.intern(value) if type(value) is str else value
+
+class CompactProto(Proto):
+	__slots__ = ("id", "layout", "values", "overrides")
+
+	def __init__(self, proto_id, layout, values, overrides=_NO_OVERRIDES):
+		"""
+			Memory-compact proto: the field names are held by a ProtoLayout
+			shared through a ProtoSchema and the interned values in a list in
+			the same order. The fields are accessed through the 'data' mapping.
+		"""
+		self.id = proto_id
+		self.layout = layout
+		self.values = values
+		self.overrides = frozenset(overrides) if overrides else _NO_OVERRIDES
+
+	@classmethod
+	def from_proto(cls, proto, schema):
+		"""
+			Create a CompactProto from any other proto
+		"""
+		data = proto.data
+		return cls(proto.id, schema.layout(data.keys()), [_intern(v) for v in data.values()], proto.overrides)
+
+	@property
+	def data(self):
+		return ProtoData(self)
+
@@ -0,0 +1,151 @@
+import re
+import bisect
+import fonlinepy.protoindex as protoindex
+
+"""
+
+	Field-level queries over the protos of read fopro files
+
+	A ProtoTable indexes the field values of all protos once. Each field has
+	an inverted index from the field value to the protos having it, and
+	fields used in numeric comparisons get a sorted column of their distinct
+	integer values. Queries only look at the distinct values of a field, not
+	at every proto.
+
+	Query conditions are strings in the format 'Field<op>Value' where <op> is
+	one of the following:
+
+	- =, != : equal or not equal to the value. Compared as integers if the
+		value is an integer, otherwise as strings.
+	- <, <=, >, >= : integer comparisons
+	- & : all bits of the value set
+	- !& : none of the bits of the value set
+
+	Protos that don't have the field never match the condition. The PID can
+	be queried with the field name 'ProtoId'.
+
+"""
+
+_condition_re = re.compile(r'^\s*([^\s=!<>&]+)\s*(=|!=|<=|>=|<|>|&|!&)\s*(.*?)\s*$')
+
+def parse_int(value):
+	"""
+		Parse a field value as integer, returns None if it isn't one
+	"""
+	try:
+		return int(value, 0)
+	except (ValueError, TypeError):
+		try:
+			return int(value)
+		except (ValueError, TypeError):
+			return None
+
+def parse_condition(text):
+	"""
+		Parse a query condition string into a (field, operator, value) tuple
+	"""
+	m = _condition_re.match(text)
+	if not m:
+		raise RuntimeError("Invalid query condition '{}'".format(text))
+	return m.group(1), m.group(2), m.group(3)
+
+class _IntColumn:
+	def __init__(self, postings):
+		values = {}
+		for value, rows in postings.items():
+			v = parse_int(value)
+			if v is not None:
+				values.setdefault(v, []).extend(rows)
+		self.keys = sorted(values) # distinct integer values
+		self.rows = [values[x] for x in self.keys] # rows of each value
+
+	def range(self, low, high):
+		"""
+			Rows with values in the slice [low, high) of self.keys
+		"""
+		result = set()
+		for rows in self.rows[low:high]:
+			result.update(rows)
+		return result
+
+class ProtoTable:
+	def __init__(self, proto_files):
+		"""
+			Index the fields of the protos in the read ProtoFiles proto_files
+		"""
+		self.rows = [] # ProtoLocation of each proto
+		self.postings = {} # field name -> {field value -> list of rows}
+		self._int_columns = {}
+
+		for x in proto_files:
+			for pid, section in x.sections.items():
+				row = len(self.rows)
+				self.rows.append(protoindex.ProtoLocation(x, section))
+				self.postings.setdefault("ProtoId", {}).setdefault(str(pid), []).append(row)
+				for k, v in section.proto.data.items():
+					self.postings.setdefault(k, {}).setdefault(v, []).append(row)
+
+	def fields(self):
+		return list(self.postings)
+
+	def _int_column(self, field):
+		col = self._int_columns.get(field)
+		if col is None:
+			col = _IntColumn(self.postings.get(field, {}))
+			self._int_columns[field] = col
+		return col
+
+	def _match(self, field, op, value):
+		postings = self.postings.get(field, {})
+		ivalue = parse_int(value)
+
+		if op in ("=", "!="):
+			if ivalue is None:
+				rows = set(postings.get(value, ()))
+			else:
+				col = self._int_column(field)
+				i = bisect.bisect_left(col.keys, ivalue)
+				rows = col.range(i, i + 1) if i < len(col.keys) and col.keys[i] == ivalue else set()
+			if op == "=":
+				return rows
+			result = set()
+			for r in postings.values():
+				result.update(r)
+			return result - rows
+
+		if ivalue is None:
+			raise RuntimeError("Query operator {} requires an integer value, got '{}'".format(op, value))
+		col = self._int_column(field)
+
+		if op == "<":
+			return col.range(0, bisect.bisect_left(col.keys, ivalue))
+		if op == "<=":
+			return col.range(0, bisect.bisect_right(col.keys, ivalue))
+		if op == ">":
+			return col.range(bisect.bisect_right(col.keys, ivalue), None)
+		if op == ">=":
+			return col.range(bisect.bisect_left(col.keys, ivalue), None)
+
+		result = set()
+		for key, rows in zip(col.keys, col.rows):
+			if op == "&" and key & ivalue == ivalue or op == "!&" and key & ivalue == 0:
+				result.update(rows)
+		return result
+
+	def select(self, conditions):
+		"""
+			Get the ProtoLocations of the protos matching all conditions,
+			in the order the protos were indexed. The conditions can be
+			condition strings or (field, operator, value) tuples.
+		"""
+		result = None
+		for c in conditions:
+			if isinstance(c, str):
+				c = parse_condition(c)
+			rows = self._match(*c)
+			result = rows if result is None else result & rows
+			if len(result) == 0:
+				break
+		if result is None:
+			return list(self.rows)
+		return [self.rows[x] for x in sorted(result)]
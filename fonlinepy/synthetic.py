@@ -0,0 +1,176 @@
+import os
+import random
+import struct
+
+"""
+
+	Synthetic FOnline server data for benchmarks
+
+	Generates a server tree with the files read by fonlinepy: fopro files
+	with items.lst, a _defines.fos including another header, FOOBJ.MSG in
+	two languages, FRM files and color.pal. The same seed always gives the
+	same data.
+
+"""
+
+ITEM_FLAGS = ["HIDDEN", "FLAT", "NO_BLOCK", "SHOOT_THRU", "LIGHT_THRU", "MULTI_HEX",
+	"WALL_TRANS_END", "TWO_HANDS", "BIG_GUN", "ALWAYS_VIEW", "HAS_TIMER", "BAD_ITEM",
+	"NO_HIGHLIGHT", "SHOW_ANIM", "SHOW_ANIM_EXT", "LIGHT", "GECK", "TRAP", "NO_LIGHT_INFLUENCE",
+	"NO_LOOT", "NO_STEAL", "GAG", "COLORIZE", "COLORIZE_INV", "CAN_USE_ON_SMTH", "CAN_LOOK",
+	"CAN_TALK", "CAN_PICKUP", "CAN_USE", "HOLODISK", "RADIO", "CACHED"]
+ITEM_TYPES = ["NONE", "ARMOR", "DRUG", "WEAPON", "AMMO", "MISC", "MISC_EX", "KEY",
+	"CONTAINER", "DOOR", "GRID", "GENERIC", "WALL", "CAR"]
+
+def write_defines(scripts_path, count, seed=0):
+	"""
+		Write _defines.fos with item flags and types and 'count' other defines,
+		and _itempid.fos with a PID define for every 'count' PID. Some of
+		the defines refer to other defines.
+	"""
+	rng = random.Random(seed)
+	os.makedirs(scripts_path, exist_ok=True)
+	with open(os.path.join(scripts_path, "_defines.fos"), "wt") as f:
+		f.write("// Synthetic defines\n")
+		for i, name in enumerate(ITEM_TYPES):
+			f.write("#define ITEM_TYPE_{:<24} ({})\n".format(name, i))
+		for i, name in enumerate(ITEM_FLAGS):
+			f.write("#define ITEM_{:<29} (0x{:08X}) // flag {}\n".format(name, 1 << i, i))
+		f.write("#define ITEM_DEFAULT_FLAGS (ITEM_CAN_PICKUP | ITEM_CAN_USE)\n")
+		for i in range(count):
+			kind = rng.randrange(4)
+			if kind == 0 and i > 0:
+				f.write("#define DEFINE_{} (DEFINE_{} + {})\n".format(i, rng.randrange(i), rng.randrange(100)))
+			elif kind == 1:
+				f.write("#define DEFINE_{} (0x{:X})\n".format(i, rng.randrange(1 << 16)))
+			elif kind == 2:
+				f.write("#define DEFINE_{} \"string {}\"\n".format(i, i))
+			else:
+				f.write("#define DEFINE_{} {}\n".format(i, rng.randrange(100000)))
+		f.write("#include \"_itempid.fos\"\n")
+	with open(os.path.join(scripts_path, "_itempid.fos"), "wt") as f:
+		for pid in range(1, count + 1):
+			f.write("#define PID_ITEM_{} ({})\n".format(pid, pid))
+
+def write_proto_tree(items_path, file_count, protos_per_file, seed=0, macros=False):
+	"""
+		Write file_count fopro files of protos_per_file protos each, and
+		items.lst listing every other file. PIDs are shuffled over the files
+		with some gaps. With macros, Type and Flags are written as $def and
+		$iflags macros. Returns list of the written PIDs.
+	"""
+	rng = random.Random(seed)
+	os.makedirs(items_path, exist_ok=True)
+	total = file_count * protos_per_file
+	pids = rng.sample(range(1, total + total // 4 + 2), total)
+	names = []
+	for n in range(file_count):
+		name = "items_{:04}.fopro".format(n)
+		names.append(name)
+		with open(os.path.join(items_path, name), "wt") as f:
+			f.write("# Synthetic protos\n\n")
+			for pid in pids[n * protos_per_file:(n + 1) * protos_per_file]:
+				f.write(_proto_text(rng, pid, macros))
+	with open(os.path.join(items_path, "items.lst"), "wt") as f:
+		for name in names[::2]:
+			f.write(name + "\n")
+	return pids
+
+def _proto_text(rng, pid, macros):
+	item_type = rng.randrange(len(ITEM_TYPES))
+	flags = [i for i in range(len(ITEM_FLAGS)) if rng.random() < 0.15]
+	lines = ["[Proto]", "ProtoId={}".format(pid)]
+	if macros:
+		lines.append("Type=$def ITEM_TYPE_{}".format(ITEM_TYPES[item_type]))
+		if flags:
+			lines.append("Flags=$iflags " + " ".join(ITEM_FLAGS[i] for i in flags))
+	else:
+		lines.append("Type={}".format(item_type))
+		lines.append("Flags={}".format(sum(1 << i for i in flags)))
+	lines.append("PicMap=art/items/item_{}.frm".format(pid % 500))
+	lines.append("PicInv=art/inven/item_{}.frm".format(pid % 500))
+	lines.append("Weight={}".format(rng.randrange(1, 20000)))
+	lines.append("Volume={}".format(rng.randrange(1, 50)))
+	lines.append("Cost={}".format(rng.randrange(0, 100000)))
+	lines.append("SoundId={}".format(rng.choice("ABCDEFGHIJ")))
+	lines.append("Material={}".format(rng.randrange(8)))
+	for i in range(rng.randrange(0, 12)):
+		lines.append("Weapon_Field{}={}".format(i, rng.randrange(-1000, 1000)))
+	if rng.random() < 0.05:
+		lines.append("# comment {}".format(pid))
+	lines.append("")
+	lines.append("")
+	return "\n".join(lines)
+
+def write_msg_file(path, pids, seed=0, language="engl", multiline=0.3):
+	"""
+		Write FOOBJ.MSG style file with a name and a description for every
+		PID in pids. A 'multiline' fraction of the descriptions spans several
+		lines.
+	"""
+	rng = random.Random(seed)
+	os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+	words = ["rusty", "old", "shiny", "heavy", "small", "military", "broken", "useful",
+		"strange", "ancient", "modified", "standard", "cheap", "precious"]
+	with open(path, "wt", encoding="utf-8") as f:
+		f.write("# Synthetic {} messages\n".format(language))
+		for pid in sorted(pids):
+			f.write("{{{}}}{{}}{{{} item {}}}\n".format(pid * 100, language, pid))
+			text = " ".join(rng.choice(words) for _ in range(rng.randrange(5, 40)))
+			if rng.random() < multiline:
+				parts = text.split(" ")
+				text = "\n".join(" ".join(parts[i:i + 6]) for i in range(0, len(parts), 6))
+			sound = "snd{}.acm".format(pid) if rng.random() < 0.1 else ""
+			f.write("{{{}}}{{{}}}{{{}}}\n".format(pid * 100 + 1, sound, text))
+
+def frm_bytes(directions, frames, width, height, seed=0, fps=10):
+	"""
+		Get the contents of a FRM file with 'directions' unique directions
+		(1 or 6) of 'frames' frames of width x height pixels
+	"""
+	rng = random.Random(seed)
+	frame_data = []
+	offsets = []
+	offset = 0
+	for d in range(directions):
+		offsets.append(offset)
+		for i in range(frames):
+			pixels = bytes(rng.randrange(256) if rng.random() < 0.7 else 0 for _ in range(width * height))
+			frame_data.append(struct.pack(">HHIhh", width, height, len(pixels), 0, 0) + pixels)
+			offset += 12 + len(pixels)
+	offsets += [offsets[-1]] * (6 - len(offsets))
+	header = struct.pack(">IHHH", 4, fps, 0, frames)
+	header += struct.pack(">hhhhhhhhhhhh", *([0] * 12))
+	header += struct.pack(">IIIIII", *offsets)
+	header += struct.pack(">I", offset)
+	return header + b"".join(frame_data)
+
+def write_art(art_path, count, directions=6, frames=8, width=40, height=60, seed=0):
+	"""
+		Write 'count' FRM files into art_path and a color.pal with a
+		grayscale palette
+	"""
+	os.makedirs(art_path, exist_ok=True)
+	paths = []
+	for n in range(count):
+		path = os.path.join(art_path, "item_{}.frm".format(n))
+		with open(path, "wb") as f:
+			f.write(frm_bytes(directions, frames, width, height, seed + n))
+		paths.append(path)
+	with open(os.path.join(art_path, "color.pal"), "wb") as f:
+		f.write(bytes(i // 4 for i in range(256) for _ in range(3)))
+		f.write(bytes(0x8000))
+	return paths
+
+def write_server(path, file_count=20, protos_per_file=500, define_count=2000,
+		frm_count=20, frames=8, seed=0, macros=False):
+	"""
+		Write a complete synthetic server tree into path
+	"""
+	os.makedirs(os.path.join(path, "data"), exist_ok=True)
+	with open(os.path.join(path, "FOnlineServer.cfg"), "wt") as f:
+		f.write("# Synthetic server\n")
+	write_defines(os.path.join(path, "scripts"), define_count, seed)
+	pids = write_proto_tree(os.path.join(path, "proto", "items"), file_count, protos_per_file, seed, macros)
+	for language in ("engl", "russ"):
+		write_msg_file(os.path.join(path, "text", language, "FOOBJ.MSG"), pids, seed, language)
+	write_art(os.path.join(path, "art", "items"), frm_count, frames=frames, seed=seed)
@@ -0,0 +1,151 @@
+import fonlinepy.frmparser as frmparser
+import fonlinepy.palette as palette
+import fonlinepy.atlas as atlas
+import fonlinepy.png as png
+import os
+import sys
+import json
+import struct
+
+"""
+	Packs the frames of all FRM files in a folder into texture atlases.
+	
+	Usage
+	
+		python3 frmatlas.py art_folder output_folder --palette color.pal
+	
+	Decodes every frame of the .frm files in 'art_folder' (including its
+	subfolders) and packs them into atlas pages of 2048x2048 pixels (set with
+	--size). The pages are written as palette PNG files 'atlas_N.png' into
+	'output_folder', using a grayscale palette unless --palette is given.
+	
+	The index 'atlas.json' is written next to the pages:
+	
+		{
+			"pages": ["atlas_0.png", ...],
+			"files": {
+				"critters/hmjmpsaa.frm": {
+					"fps": 10,
+					"num_frames": 8,
+					"shifts": [[x, y], ... one pair for each direction],
+					"directions": [
+						[[page, x, y, width, height, shift_x, shift_y], ... each frame],
+						... each direction
+					]
+				}
+			}
+		}
+"""
+
+def _frame_sizes(frm):
+	"""
+		Get the rectangle lists of each direction of frm, frames of
+		directions sharing their offset sharing the lists, and list of
+		(direction, index, width, height, shift_x, shift_y, rect) of the
+		frames of each unique direction. No pixel views are kept.
+	"""
+	directions = []
+	by_offset = {}
+	frames = []
+	for d in range(6):
+		off = frm.header["direction_byte_offsets"][d]
+		if off not in by_offset:
+			by_offset[off] = [[] for x in range(frm.num_frames)]
+			sizes = [(x["width"], x["height"], x["shift_x"], x["shift_y"]) for x in frm.direction(d)]
+			for i, size in enumerate(sizes):
+				frames.append((d, i) + size + (by_offset[off][i],))
+		directions.append(by_offset[off])
+	return directions, frames
+
+def _copy_frames(frm, frames, positions, pages, page_size):
+	"""
+		Copy the pixels of frames, (direction, index) pairs, of frm into
+		their positions in pages
+	"""
+	for (d, i), (page, x, y) in zip(frames, positions):
+		frame = frm.frame(d, i)
+		w = frame["width"]
+		h = frame["height"]
+		pixels = frame["pixels"]
+		if w > 0 and h > 0:
+			buf = pages[page]
+			for row in range(h):
+				dst = (y + row) * page_size + x
+				buf[dst:dst + w] = pixels[row * w:(row + 1) * w]
+
+def build_atlas(frm_paths, base_folder, page_size, padding=1):
+	"""
+		Pack the frames of frm_paths. Returns list of page pixel buffers and
+		the index dictionary described above (without page file names).
+		
+		The files are read twice, one at a time: first for the frame sizes,
+		then for copying the pixels into the packed pages.
+	"""
+	files = {}
+	frames = [] # (path, direction, index, width, height, shift_x, shift_y, rect list to fill)
+	for path in frm_paths:
+		name = os.path.relpath(path, base_folder).replace(os.sep, "/")
+		try:
+			with frmparser.FrmFile.open(path) as frm:
+				directions, file_frames = _frame_sizes(frm)
+		except (RuntimeError, OSError, struct.error) as e:
+			print("Skipping {}: {}".format(path, e), file=sys.stderr)
+			continue
+		frames.extend((path,) + x for x in file_frames)
+		files[name] = {
+			"fps": frm.fps,
+			"num_frames": frm.num_frames,
+			"shifts": [list(x) for x in frm.shifts],
+			"directions": directions
+		}
+
+	positions = atlas.pack_rects([(f[3], f[4]) for f in frames], page_size, page_size, padding)
+	
+	page_count = max([p for p, x, y in positions], default=-1) + 1
+	pages = [bytearray(page_size * page_size) for x in range(page_count)]
+	by_path = {}
+	for (path, d, i, w, h, shift_x, shift_y, rect), (page, x, y) in zip(frames, positions):
+		rect.extend([page, x, y, w, h, shift_x, shift_y])
+		if w > 0 and h > 0:
+			entry = by_path.setdefault(path, ([], []))
+			entry[0].append((d, i))
+			entry[1].append((page, x, y))
+	
+	for path, (file_frames, file_positions) in by_path.items():
+		try:
+			with frmparser.FrmFile.open(path) as frm:
+				_copy_frames(frm, file_frames, file_positions, pages, page_size)
+		except (RuntimeError, OSError, struct.error) as e:
+			print("Failed to copy the frames of {}: {}".format(path, e), file=sys.stderr)
+	return pages, {"files": files}
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="FRM atlas packer")
+	parser.add_argument("input", type=str)
+	parser.add_argument("output", type=str)
+	parser.add_argument("--palette", type=str, help="path to color.pal")
+	parser.add_argument("--size", type=int, default=2048, help="width and height of the atlas pages")
+	parser.add_argument("--padding", type=int, default=1, help="pixels between the frames")
+	args = parser.parse_args()
+	
+	pal = palette.Palette.load(args.palette) if args.palette else None
+	paths = frmparser.find_frm_files(args.input)
+	print("Packing {} FRM files".format(len(paths)), file=sys.stderr)
+	
+	try:
+		pages, index = build_atlas(paths, args.input, args.size, args.padding)
+	except RuntimeError as e:
+		print(e, file=sys.stderr)
+		sys.exit(1)
+	
+	if not os.path.exists(args.output):
+		os.makedirs(args.output)
+	index["pages"] = []
+	for i, page in enumerate(pages):
+		name = "atlas_{}.png".format(i)
+		png.write_indexed(os.path.join(args.output, name), args.size, args.size, page, pal)
+		index["pages"].append(name)
+	with open(os.path.join(args.output, "atlas.json"), "wt") as f:
+		json.dump(index, f, separators=(",", ":"))
+	print("Packed {} files into {} pages".format(len(index["files"]), len(pages)), file=sys.stderr)
@@ -0,0 +1,182 @@
+import fonlinepy.frmparser as frmparser
+import fonlinepy.palette as palette
+import fonlinepy.png as png
+import os
+import sys
+import json
+import struct
+import concurrent.futures
+
+"""
+	Validates and converts all FRM files in a folder.
+
+	Usage
+
+		python3 frmconvert.py art_folder
+
+	Validates the header and frames of every .frm file in 'art_folder' and its
+	subfolders.
+
+		python3 frmconvert.py art_folder --output out_folder --palette color.pal
+
+	Validates the files and converts their frames into PNG files in
+	'out_folder', keeping the folder structure. The frames of 'critters/a.frm'
+	are written as 'critters/a_<direction>_<frame>.png', followed by
+	'critters/a.json' listing the frames with their sizes and shifts. Files
+	whose .json is newer than both the FRM file and the palette, and was
+	written with the same --format, are skipped unless --force is given.
+
+	With --format rgba the frames are written as raw RGBA data into '.rgba'
+	files instead. Without --palette a grayscale palette is used.
+
+	The files are processed in parallel using all CPUs by default, use --jobs
+	to change the number of worker processes. Results are printed as soon as
+	each file is done. Exits with status 1 if any file is invalid.
+"""
+
+_palettes = {}
+
+def _get_palette(palette_path):
+	if palette_path not in _palettes:
+		if palette_path:
+			_palettes[palette_path] = palette.Palette.load(palette_path)
+		else:
+			_palettes[palette_path] = palette.Palette.grayscale()
+	return _palettes[palette_path]
+
+def _is_up_to_date(path, index_path, fmt, palette_path):
+	try:
+		out_mtime = os.stat(index_path).st_mtime
+	except OSError:
+		return False
+	if os.stat(path).st_mtime > out_mtime:
+		return False
+	if palette_path and os.stat(palette_path).st_mtime > out_mtime:
+		return False
+	try:
+		with open(index_path) as f:
+			return json.load(f).get("format") == fmt
+	except (OSError, ValueError, AttributeError):
+		return False
+
+def _convert(frm, rel, output_folder, fmt, palette_path):
+	"""
+		Parse all frames of frm and write them into output_folder if given.
+		Returns the number of frames and the index of the written frames.
+	"""
+	directions = {d: frm.direction(d) for d in frm.unique_directions()}
+	frame_count = sum(len(x) for x in directions.values())
+	if not output_folder:
+		return frame_count, None
+
+	pal = _get_palette(palette_path)
+	by_offset = {}
+	for d, frames in directions.items():
+		entries = []
+		for i, frame in enumerate(frames):
+			name = "{}_{}_{}.{}".format(rel, d, i, fmt)
+			out_path = os.path.join(output_folder, name)
+			w, h = frame["width"], frame["height"]
+			if fmt == "png":
+				png.write_indexed(out_path, w, h, frame["pixels"], pal)
+			else:
+				with open(out_path, "wb") as f:
+					f.write(pal.rgba_bytes(frame["pixels"]))
+			entries.append({
+				"file": os.path.basename(name),
+				"width": w,
+				"height": h,
+				"shift_x": frame["shift_x"],
+				"shift_y": frame["shift_y"]
+			})
+		by_offset[frm.header["direction_byte_offsets"][d]] = entries
+	index = {
+		"format": fmt,
+		"fps": frm.fps,
+		"num_frames": frm.num_frames,
+		"shifts": [list(x) for x in frm.shifts],
+		"directions": [by_offset[x] for x in frm.header["direction_byte_offsets"]]
+	}
+	return frame_count, index
+
+def process_frm(path, base_folder, output_folder=None, fmt="png", palette_path=None, force=False):
+	"""
+		Validate FRM file at path and convert its frames into output_folder if
+		given. Returns (status, message) where status is "ok", "skipped" or
+		"invalid".
+	"""
+	rel = os.path.splitext(os.path.relpath(path, base_folder))[0]
+	index_path = None
+	if output_folder:
+		index_path = os.path.join(output_folder, rel + ".json")
+		if not force and _is_up_to_date(path, index_path, fmt, palette_path):
+			return "skipped", ""
+		os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+
+	try:
+		frm = frmparser.FrmFile.open(path)
+	except (RuntimeError, OSError, struct.error) as e:
+		return "invalid", str(e)
+
+	with frm:
+		try:
+			frame_count, index = _convert(frm, rel, output_folder, fmt, palette_path)
+		except (RuntimeError, struct.error) as e:
+			return "invalid", str(e)
+	
+	if index is not None:
+		# The index is written last: its modification time marks the conversion as complete
+		with open(index_path, "wt") as f:
+			json.dump(index, f)
+	return "ok", "{} frames".format(frame_count)
+
+def process_all(paths, base_folder, output_folder=None, fmt="png", palette_path=None, force=False, jobs=None):
+	"""
+		Process FRM files in parallel, generating (path, status, message)
+		tuples as the files finish. At most two files per worker are queued
+		at a time.
+	"""
+	jobs = jobs or os.cpu_count() or 1
+	paths = iter(paths)
+	with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+		pending = {}
+		def submit():
+			for path in paths:
+				f = executor.submit(process_frm, path, base_folder, output_folder, fmt, palette_path, force)
+				pending[f] = path
+				if len(pending) >= jobs * 2:
+					return
+		submit()
+		while pending:
+			done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+			for f in done:
+				path = pending.pop(f)
+				try:
+					status, message = f.result()
+				except OSError as e:
+					status, message = "invalid", str(e)
+				yield path, status, message
+			submit()
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="FRM validator and converter")
+	parser.add_argument("input", type=str)
+	parser.add_argument("--output", type=str)
+	parser.add_argument("--format", choices=["png", "rgba"], default="png")
+	parser.add_argument("--palette", type=str, help="path to color.pal")
+	parser.add_argument("--force", action="store_true", help="convert files even if the output is up to date")
+	parser.add_argument("--jobs", type=int, help="number of worker processes")
+	args = parser.parse_args()
+
+	counts = {"ok": 0, "skipped": 0, "invalid": 0}
+	paths = frmparser.find_frm_files(args.input)
+	for path, status, message in process_all(paths, args.input, args.output, args.format, args.palette, args.force, args.jobs):
+		counts[status] += 1
+		if status == "invalid":
+			print("INVALID {}: {}".format(path, message))
+		elif status == "ok":
+			print("OK {} ({})".format(path, message))
+	print("{} ok, {} skipped, {} invalid".format(counts["ok"], counts["skipped"], counts["invalid"]), file=sys.stderr)
+	if counts["invalid"] > 0:
+		sys.exit(1)
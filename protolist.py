@@ -1,6 +1,13 @@
 import fonlinepy.protofile as protofile
+import fonlinepy.protocache as protocache
+import fonlinepy.protoindex as protoindex
+import fonlinepy.protoquery as protoquery
+import fonlinepy.protoexport as protoexport
+import fonlinepy.protomsg as protomsg
+import fonlinepy.msgfile as msgfile
 import fonlinepy.headerparser as headerparser
 import fonlinepy.server as server
+import fonlinepy.profiling as profiling
 import re
 
 """
@@ -19,6 +26,31 @@ import re
 		python3 protolist.py input_folder --locate 5261
 	
 	Finds the location of PID 5261 in 'input_folder'
+	
+		python3 protolist.py input_folder --query "Type=3" --query "Cost>500"
+	
+	Lists the protos matching all of the query conditions. See
+	fonlinepy/protoquery.py for the condition syntax.
+	
+		python3 protolist.py input_folder --export protos.npz
+	
+	Exports the proto fields as columns into a numpy .npz file (or a .parquet
+	file if pyarrow is installed).
+	
+		python3 protolist.py input_folder --msg text/engl/FOOBJ.MSG
+	
+	Cross-references the protos with FOOBJ.MSG: lists protos without a name
+	(message PID*100) or description (message PID*100+1), messages of PIDs
+	not defined in any proto and messages defined more than once.
+	
+	Use --profile to print the time spent reading and parsing each file and
+	in the other steps, or --profile trace.json to save the timings as a
+	Chrome trace (open it in chrome://tracing or Perfetto).
+	
+	The files are read in parallel using all CPUs by default, use --jobs to
+	change the number of worker processes. Use --cache-dir to keep the parsed
+	protos in a cache directory, so that unchanged files are not parsed again
+	on the next run.
 """
 
 if __name__ == "__main__":
@@ -31,7 +63,18 @@ if __name__ == "__main__":
 	parser.add_argument("--locate", type=int)
 	parser.add_argument("--active-only", action="store_true")
 	parser.add_argument("--print", action="store_true")
+	parser.add_argument("--query", action="append", help="list protos matching the condition, can be given multiple times")
+	parser.add_argument("--export", type=str, help="export the proto fields into a .npz or .parquet file")
+	parser.add_argument("--msg", type=str, help="path to FOOBJ.MSG to cross-reference the protos with")
+	parser.add_argument("--jobs", type=int, help="number of worker processes used to read the files")
+	parser.add_argument("--cache-dir", type=str, help="directory for caching parsed protos")
+	parser.add_argument("--profile", nargs="?", const="-", metavar="TRACE_FILE",
+		help="print the time spent in each step on exit, or write it into a Chrome trace file")
 	args = parser.parse_args()
+	if args.profile:
+		import atexit
+		profiling.enable()
+		atexit.register(profiling.report, args.profile)
 	input_folder = args.input
 	free_pids = args.free
 	locate = args.locate
@@ -40,45 +83,65 @@ if __name__ == "__main__":
 	
 	total_protos = 0
 	
-	proto_id_dict = {}
-	proto_ids = []
-	
 	protos = protofile.load_freestanding_proto_files(input_folder)
+	if active_only:
+		protos = [x for x in protos if x.active]
+	cache = protocache.ProtoCache(args.cache_dir) if args.cache_dir else None
+	protos = protofile.read_proto_files(protos, args.jobs, cache=cache, read_lines=False)
 	for x in protos:
-		if active_only and not x.active:
-			continue
-		x.read_file()
-		x.read_sections()
-		update_count = 0
 		proto_cnt = len(x.sections)
 		if print_protos:
 			print("Proto file {} ({}) containing {} protos".format(x.name, "ACTIVE" if x.active else "INACTIVE", proto_cnt))
 		total_protos += proto_cnt
-		for pid, sect in x.sections.items():
-			fn = x.name
-			line = sect.line_range[0]
-			proto_ids.append(pid)
-			if pid in proto_id_dict:
-				print("Proto conflict, PID {}: first occurence in {} line {}, conflicting occurence in {} line {}".format(pid, proto_id_dict[pid][0], proto_id_dict[pid][1], fn, line), file=sys.stderr)
-			else:
-				proto_id_dict[pid] = (fn, line)
+	
+	with profiling.span("index"):
+		index = protoindex.ProtoIndex(protos)
+	for pid, locs in index.conflicts():
+		first = locs[0]
+		for other in locs[1:]:
+			print("Proto conflict, PID {}: first occurence in {} line {}, conflicting occurence in {} line {}".format(pid, first.proto_file.name, first.line_range[0], other.proto_file.name, other.line_range[0]), file=sys.stderr)
 	if free_pids:
-		proto_ids = sorted(proto_ids)
-		p_idx = 0
-		idx = 1
-		while free_pids > 0:
-			if len(proto_ids) <= p_idx:
-				print(idx)
-				free_pids -= 1
-			else:
-				if proto_ids[p_idx] > idx:
-					print(idx)
-					free_pids -= 1
-				else:
-					p_idx += 1
-			idx += 1
+		for pid in index.free_pids(free_pids):
+			print(pid)
 	if locate:
-		if not locate in proto_id_dict:
+		loc = index.lookup(locate)
+		if loc is None:
 			print("PID {} not found".format(locate), file=sys.stderr)
 		else:
-			print("PID {} found in {} line {}".format(locate, proto_id_dict[locate][0], proto_id_dict[locate][1]))
+			print("PID {} found in {} line {}".format(locate, loc.proto_file.name, loc.line_range[0]))
+	if args.msg:
+		try:
+			with msgfile.MsgFile.open(args.msg) as msg:
+				with profiling.span("cross_reference", args.msg):
+					report = protomsg.cross_reference(index, msg)
+		except (OSError, RuntimeError, UnicodeDecodeError) as e:
+			print("Failed to read {}: {}".format(args.msg, e), file=sys.stderr)
+			sys.exit(1)
+		for pid in report.missing_names:
+			loc = index.lookup(pid)
+			print("Missing name, PID {} in {} line {}".format(pid, loc.proto_file.name, loc.line_range[0]))
+		for pid in report.missing_descriptions:
+			loc = index.lookup(pid)
+			print("Missing description, PID {} in {} line {}".format(pid, loc.proto_file.name, loc.line_range[0]))
+		for num in report.orphans:
+			print("Orphaned message {}, PID {} not found".format(num, num // 100))
+		for num in report.duplicate_messages:
+			print("Duplicate message {}".format(num))
+	if args.query:
+		with profiling.span("query_table"):
+			table = protoquery.ProtoTable(protos)
+		try:
+			with profiling.span("query"):
+				locs = table.select(args.query)
+			for loc in locs:
+				print("PID {} in {} line {}".format(loc.section.proto.id, loc.proto_file.name, loc.line_range[0]))
+		except RuntimeError as e:
+			print(e, file=sys.stderr)
+			sys.exit(1)
+	if args.export:
+		try:
+			with profiling.span("export", args.export):
+				protoexport.export(args.export, protos)
+		except (RuntimeError, ImportError) as e:
+			print("Failed to export protos: {}".format(e), file=sys.stderr)
+			sys.exit(1)
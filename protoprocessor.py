@@ -1,7 +1,16 @@
 import fonlinepy.protofile as protofile
+import fonlinepy.protocache as protocache
 import fonlinepy.headerparser as headerparser
+import fonlinepy.itemflags as itemflags
+import fonlinepy.macros as macros
+import fonlinepy.msgcorpus as msgcorpus
 import fonlinepy.server as server
-import re
+import fonlinepy.profiling as profiling
+import os
+import sys
+import time
+import locale
+import tempfile
 
 """
 	Preprocesses fopro files using macros. All files from input folder are processed.
@@ -12,10 +21,24 @@ import re
 	
 	- $def DEFINE_NAME
 		Substitutes value field with the value of preprocessor define
-		DEFINE_NAME found in _defines.fos
+		DEFINE_NAME found in _defines.fos or the files it includes. Defines
+		referring to other defines, such as '#define A (B | C)', are resolved.
 	- $iflags FLAG1 FLAG2 FLAG3
 		Expands into bitwise or combination of ITEM_* flags defined in _defines.fos.
 		The 'ITEM_' prefix is automatically appended before each flag name.
+	- $pid NAME
+		Substitutes value field with the value of define PID_NAME.
+	- $expr EXPRESSION
+		Substitutes value field with the value of an arithmetic or bitwise
+		expression of defines, e.g. '$expr ITEM_HIDDEN | ITEM_FLAT'.
+	- $msg FILE NUMBER
+		Substitutes value field with the text of message NUMBER of
+		text/<language>/FILE.MSG, e.g. '$msg FOOBJ 1200'. NUMBER can be a
+		define. The language is selected with --language, the macro fails
+		without it, and the encoding of the MSG files with --msg-encoding
+		(utf-8 by default). Messages spanning several lines can't be used.
+	
+	The macros are implemented in fonlinepy/macros.py.
 		
 	Reverse flags performs the following operations:
 	
@@ -43,84 +66,249 @@ import re
 		python3 protoprocessor.py my_folder
 	
 	Performs a dry preprocessing run. None of the results are saved.
+	
+	Output files are only written if their content changes, so unchanged
+	files keep their modification times. Files are replaced atomically.
+	
+		python3 protoprocessor.py folder1 --output folder2 --watch
+	
+	Processes all files once and then keeps watching 'folder1', processing
+	again only the files that have been modified. Everything is processed
+	again if _defines.fos or a file it includes is modified, or with
+	--language a MSG file of the language.
+	
+	Use --profile to print the time spent reading, parsing, processing and
+	writing each file, or --profile trace.json to save the timings as a
+	Chrome trace (open it in chrome://tracing or Perfetto).
+	
+	The files are read in parallel using all CPUs by default, use --jobs to
+	change the number of worker processes. Use --cache-dir to keep the parsed
+	protos and the resolved defines in a cache directory, so that unchanged
+	files are not parsed again on the next run.
 """
 
-_iflags_re = re.compile(r'\$iflags\s+(.+)$', re.I)
-_def_re = re.compile(r'\$def\s+([^\s]+)', re.I)
+DEFINES_PATH = "scripts/_defines.fos"
+MSG_CACHE_NAME = "msg.cache"
+
+def load_defines(spath, cache_path=None):
+	"""
+		Load the define table and compiled item flags from the _defines.fos of server
+		spath and the files it includes. The resolved defines are cached in
+		directory cache_path if given.
+	"""
+	table = headerparser.load_define_table(spath, DEFINES_PATH, cache_path)
+	classification = headerparser.classify_item_defines(table.values)
+	for x in classification.duplicates:
+		print(headerparser.describe_duplicate(x), file=sys.stderr)
+	iflags = itemflags.ItemFlags(table.values, classification.reverse)
+	return table, iflags
+
+def load_strings(spath, language, cache_path=None, encoding="utf-8"):
+	"""
+		Load the MsgCorpus with the string tables of language of server
+		spath for the $msg macro, decoded with encoding. The parsed tables
+		are cached in directory cache_path if given.
+	"""
+	msg_cache = None
+	if cache_path:
+		os.makedirs(cache_path, exist_ok=True)
+		msg_cache = os.path.join(cache_path, MSG_CACHE_NAME)
+	corpus = msgcorpus.load_corpus(spath, msg_cache, encoding=encoding, languages=[language])
+	if language not in corpus.tables:
+		raise OSError("No text folder for language {}".format(language))
+	return corpus
+
+def load_engine(spath, reverse=False, cache_path=None, language=None, msg_encoding="utf-8"):
+	"""
+		Load the defines of server spath, and the string tables of language
+		if given, and get the function processing proto key-value pairs,
+		the loaded DefineTable and the loaded MsgCorpus (None without
+		language)
+	"""
+	table, iflags = load_defines(spath, cache_path)
+	corpus = load_strings(spath, language, cache_path, msg_encoding) if language else None
+	engine = macros.standard_engine(table.values, iflags, corpus.tables[language] if corpus else None)
+	return (engine.reverse if reverse else engine.expand), table, corpus
 
-def process_macros(key, value, defines, iflags):
-	"""
-		Process macros in a proto key-value pair
-	"""
-	
-	# $def
-	m = _def_re.match(value)
-	if m:
-		if not m[1] in defines:
-			raise RuntimeError("Unknown define {}".format(m[1]))
-		return defines[m[1]]
-	# $iflags
-	m = _iflags_re.match(value)
-	if m:
-		lst = m[1].split()
-		val = 0
-		for df in lst:
-			defname = "ITEM_" + df
-			if not defname in defines:
-				raise RuntimeError("Unknown item flag {}".format(defname))
-			val = val | defines[defname]
-		return str(val)
+def process_proto_file(x, process_func, output_path):
+	"""
+		Process the macros of the read ProtoFile x with process_func(key,
+		value) and write the result in folder output_path if given. Returns
+		True if the output file was written, False if it was already up to
+		date and None without output_path.
+	"""
+	update_count = 0
+	proto_cnt = len(x.sections)
+	print("Checking protofile at {} ({}), {} protos".format(x.name, "ACTIVE" if x.active else "INACTIVE", proto_cnt), file=sys.stderr)
+	with profiling.span("process_macros", x.name), x.batch() as updates:
+		for pid, protosec in x.sections.items():
+			for k, v in protosec.proto.data.items():
+				try:
+					procd = process_func(k, v)
+					if procd is not None:
+						protosec.proto.data[k] = procd
+						updates[pid] = protosec.proto.data
+						update_count += 1
+				except RuntimeError as e:
+					print("At {} on proto {} starting at line {}: {}".format(x.name, pid, protosec.line_range[0], e))
+	profiling.count("fields_updated", update_count)
+	if update_count > 0:
+		print("Updated {} proto fields".format(update_count))
+	if output_path:
+		with profiling.span("write_output", x.name):
+			outfile = os.path.join(output_path, x.name)
+			data = "".join(l + "\n" for l in x.lines)
+			if os.linesep != "\n":
+				data = data.replace("\n", os.linesep)
+			encoding = locale.getpreferredencoding(False)
+			try:
+				data = data.encode(encoding)
+			except UnicodeEncodeError as e:
+				# Such as $msg texts the locale can't represent
+				print("Failed to write {} in encoding {}: {}".format(x.name, encoding, e), file=sys.stderr)
+				return False
+			written = write_if_changed(outfile, data)
+		profiling.count("files_written" if written else "files_unchanged")
+		return written
 	return None
 
-def process_reverse(key, value, defines, iflags):
+def write_if_changed(path, data):
 	"""
-		Convert proto key value pair into one with macros for more readability
+		Write bytes data into file at path unless the file already has the
+		same content. The file is replaced atomically through a temporary
+		file in the same folder. Returns True if the file was written.
 	"""
+	try:
+		st = os.stat(path)
+	except OSError:
+		st = None
+	if st is not None and st.st_size == len(data):
+		with open(path, "rb") as f:
+			if f.read() == data:
+				return False
 	
-	# Convert 'Flags' field into $iflags format
-	if key == "Flags":
-		flags = ""
-		try:
-			value = int(value)
-		except:
-			# Failed to parse value as integer, just return
-			return None
-		idx = 0
-		# go through all the bits in the value
-		while value > 0:
-			exp = 2**idx
-			assert value >= exp
-			if value & exp:
-				value -= exp
-				if exp not in iflags["item_flags"]:
-					raise RuntimeError("No item flag found for value bit {}".format(exp))
-				flag_name = iflags["item_flags"][exp]
-				flags = flags + " " + flag_name
-			idx += 1
-		if len(flags) > 0:
-			return "$iflags" + flags
-	
-	# Convert 'Type' field into $def format
-	if key == "Type":
+	if st is not None:
+		mode = st.st_mode & 0o7777
+	else:
+		umask = os.umask(0)
+		os.umask(umask)
+		mode = 0o666 & ~umask
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.chmod(tmp_path, mode)
+		os.replace(tmp_path, path)
+	except BaseException:
+		os.unlink(tmp_path)
+		raise
+	return True
+
+def scan_modification_times(input_folder):
+	"""
+		Get the modification times of the fopro files in input_folder
+	"""
+	mtimes = {}
+	try:
+		with os.scandir(input_folder) as scandir:
+			for x in scandir:
+				if x.name.endswith(".fopro"):
+					mtimes[x.name] = x.stat().st_mtime
+	except OSError as e:
+		print("Failed to read directory {}: {}".format(input_folder, e), file=sys.stderr)
+	return mtimes
+
+def read_modified_files(protos, jobs=None, cache=None):
+	"""
+		Read the ProtoFiles protos for watch mode. If any of them can't be
+		read, for example because it was removed after scanning, the files
+		are read again one by one and the failing ones are left out.
+	"""
+	try:
+		return protofile.read_proto_files(protos, jobs, cache=cache)
+	except OSError:
+		pass
+	result = []
+	for x in protos:
 		try:
-			value = int(value)
-		except:
-			return None
-		if value in iflags["item_types"]:
-			return "$def " + iflags["item_types"][value]
-	return None
+			result += protofile.read_proto_files([x], 1, cache=cache)
+		except OSError as e:
+			print("Failed to read {}: {}".format(x.name, e), file=sys.stderr)
+	return result
 
+def watch(input_folder, output_path, reverse, spath, jobs=None, cache=None, interval=1.0, language=None, msg_encoding="utf-8"):
+	"""
+		Process the files in input_folder whenever they are modified. The
+		defines and the processed ProtoFiles are kept in memory between
+		rounds: only modified files are read again, unless _defines.fos,
+		a file it includes or a MSG file of language changes in which case
+		all files are processed again.
+	"""
+	table = corpus = process_func = None
+	proto_files = {} # processed ProtoFiles by file name
+	
+	while True:
+		if table is None or table.is_modified() or (corpus is not None and corpus.is_modified()):
+			if table is not None:
+				print("{}, a file it includes or a MSG file modified, processing all files".format(DEFINES_PATH), file=sys.stderr)
+			try:
+				process_func, table, corpus = load_engine(spath, reverse, cache.cache_path if cache else None, language, msg_encoding)
+			except OSError as e:
+				print("Failed to load server files: {}".format(e), file=sys.stderr)
+				time.sleep(interval)
+				continue
+			proto_files = {}
+		
+		mtimes = scan_modification_times(input_folder)
+		for name in list(proto_files):
+			if name not in mtimes:
+				del proto_files[name]
+		
+		modified = [name for name, m in mtimes.items()
+			if name not in proto_files or proto_files[name].last_modification != m]
+		if len(modified) > 0:
+			protos = protofile.load_freestanding_proto_files(input_folder)
+			protos = [x for x in protos if x.name in modified]
+			protos = read_modified_files(protos, jobs, cache)
+			written = 0
+			for x in protos:
+				try:
+					if process_proto_file(x, process_func, output_path):
+						written += 1
+					if output_path:
+						# Don't process the file again if it was overwritten by the output
+						outfile = os.path.join(output_path, x.name)
+						if os.path.samefile(outfile, x.path):
+							x.last_modification = os.stat(x.path).st_mtime
+				except OSError as e:
+					# Left out of proto_files, so it is tried again next round
+					print("Failed to process {}: {}".format(x.name, e), file=sys.stderr)
+					continue
+				proto_files[x.name] = x
+			if output_path:
+				print("{} files written, {} unchanged".format(written, len(protos) - written), file=sys.stderr)
+		time.sleep(interval)
 
 if __name__ == "__main__":
-	import sys
-	import os
 	import argparse
 	parser = argparse.ArgumentParser(description="fopro preprocessor")
 	parser.add_argument("input", type=str)
 	parser.add_argument("--output", type=str)
 	parser.add_argument("--reverse", action="store_true")
 	parser.add_argument("--server-path", type=str)
+	parser.add_argument("--language", type=str, help="language folder of the string tables used by $msg, e.g. engl")
+	parser.add_argument("--msg-encoding", type=str, default="utf-8", help="encoding of the MSG files used by $msg, e.g. cp1251")
+	parser.add_argument("--jobs", type=int, help="number of worker processes used to read the files")
+	parser.add_argument("--cache-dir", type=str, help="directory for caching parsed protos")
+	parser.add_argument("--watch", action="store_true", help="keep processing modified files")
+	parser.add_argument("--interval", type=float, default=1.0, help="seconds between checks for modified files in watch mode")
+	parser.add_argument("--profile", nargs="?", const="-", metavar="TRACE_FILE",
+		help="print the time spent in each step on exit, or write it into a Chrome trace file")
 	args = parser.parse_args()
+	if args.profile:
+		import atexit
+		profiling.enable()
+		atexit.register(profiling.report, args.profile)
 	output_path = args.output
 	reverse = args.reverse
 	input_folder = args.input
@@ -131,41 +319,31 @@ if __name__ == "__main__":
 		print("Failed to locate server path: cannot load server files", file=sys.stderr)
 		sys.exit(1)
 	
-	defines = headerparser.parse_header_file(spath, "scripts/_defines.fos")
-	defines = dict(defines)
-	iflags = headerparser.get_item_flags(defines)
-	
-	process_func = process_reverse if reverse else process_macros
-	
 	if output_path:
 		if not os.path.exists(output_path):
 			os.makedirs(output_path)
 	
+	cache = protocache.ProtoCache(args.cache_dir) if args.cache_dir else None
+	
+	if args.watch:
+		try:
+			watch(input_folder, output_path, reverse, spath, args.jobs, cache, args.interval, args.language, args.msg_encoding)
+		except KeyboardInterrupt:
+			pass
+		sys.exit(0)
+	
+	try:
+		process_func, table, corpus = load_engine(spath, reverse, args.cache_dir, args.language, args.msg_encoding)
+	except OSError as e:
+		print("Failed to load server files: {}".format(e), file=sys.stderr)
+		sys.exit(1)
+	
 	protos = protofile.load_freestanding_proto_files(input_folder)
 	#protos = protofile.load_proto_files(spath)
+	protos = protofile.read_proto_files(protos, args.jobs, cache=cache)
+	written = 0
 	for x in protos:
-		x.read_file()
-		x.read_sections()
-		update_count = 0
-		proto_cnt = len(x.sections)
-		print("Checking protofile at {} ({}), {} protos".format(x.name, "ACTIVE" if x.active else "INACTIVE", proto_cnt), file=sys.stderr)
-		for pid, protosec in x.sections.items():
-			changed = False
-			for k, v in protosec.proto.data.items():
-				try:
-					procd = process_func(k, v, defines, iflags)
-					if procd:
-						protosec.proto.data[k] = procd
-						changed = True
-						update_count += 1
-				except RuntimeError as e:
-					print("At {} on proto {} starting at line {}: {}".format(x.name, pid, protosec.line_range[0], e))
-			if changed:
-				x.update_proto(pid, protosec.proto.data)
-		if update_count > 0:
-			print("Updated {} proto fields".format(update_count))
-		if output_path:
-			outfile = os.path.join(output_path, x.name)
-			with open(outfile, "wt") as of:
-				for l in x.lines:
-					print(l, file=of)
+		if process_proto_file(x, process_func, output_path):
+			written += 1
+	if output_path:
+		print("{} files written, {} unchanged".format(written, len(protos) - written), file=sys.stderr)